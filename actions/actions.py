@@ -1,9 +1,8 @@
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 import datetime as dt
 import dateutil.parser
-import itertools
+import functools
 import logging
-import random
 import sqlite3
 from typing import Any, Text, Dict, List, Optional
 import os
@@ -13,17 +12,57 @@ from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.events import SlotSet, FollowupAction, AllSlotsReset
 from rasa_sdk.types import DomainDict
 
+from . import book_lookup
+from . import borrow
 from . import library_config as config
-from . import search
+from . import db_pool
+from . import identity
+from . import opening_calendar
+from .db_executor import ThreadedActionMixin
+from . import queries
 
 logger = logging.getLogger(__name__)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# name of the input channel of alexa_connector.AlexaConnector
+ALEXA_CHANNEL = "alexa_assistant"
+
+# a found book as kept in the found_books and narrowed_found_books slots
+BookRecord = namedtuple("BookRecord", [
+    "book_id",
+    "title",
+    "author_ids",
+    "author_names",
+    "author_str",
+    "is_available",
+    "due_date"
+])
+
+def book_record(value):
+    """Read a found book of the slots as a BookRecord.
+    Conversations stored by older versions hold [book_id, title, author_ids, author_names],
+    later with author_str, the missing fields are derived or left unknown.
+    :params
+        value: list from a found books slot
+    :return
+        BookRecord
+    """
+    book_id, title, author_ids, author_names = value[:4]
+    author_str = value[4] if len(value) > 4 else book_lookup.format_author_names(author_names)
+    is_available, due_date = (list(value[5:7]) + [None, None])[:2]
+    return BookRecord(book_id, title, author_ids, author_names, author_str, is_available, due_date)
+
+def slot_found_books(tracker):
+    """The found books the user selects from, the narrowed ones after an ambiguous selection."""
+    found_books = tracker.get_slot("narrowed_found_books" if tracker.get_slot("is_ambiguous") else "found_books")
+    return [book_record(value) for value in found_books or []]
+
+@functools.lru_cache(maxsize=64)
 def format_opentime(open_hours):
-    """Format the opening hours into strings.
+    """Format the opening hours into strings, the few distinct days are formatted once.
     :params
-        open_hours: list of datetime.date
+        open_hours: tuple of (datetime.time, datetime.time)
     :return
         hour_min_str: str of formatted time
     """
@@ -65,54 +104,28 @@ def get_suffix(day):
         suffix = ["st", "nd", "rd"][day % 10 - 1]
     return suffix
 
-def format_query_list(lenl, query):
-    """Format a query with appropriate number of placeholders for parameters
-    :params
-        lenl: int length for how many placeholder to be placed
-        query: str of sqlite query 
-    :return
-        formatted_query: str of sqlite query 
-    """
-    placeholder = '?'  
-    placeholders = ', '.join([placeholder]*lenl)
-    formatted_query = query % placeholders
-    return formatted_query
-
 def find_next_open_date(next_open_day):
     """Fine next open dates for a given date
     :params
         next_open_day: datetime.date 
     :return
         day_of_week: str
-        new_open_hours: list of tuple
+        new_open_hours: tuple of tuple
         month: str
         day: int
         year: int
+        or None if the library stays closed
     """
-    while next_open_day in config.YEARLY_HOLIDAYS:
-        next_open_day += dt.timedelta(days=1)
+    next_open = opening_calendar.get_calendar().next_open_date(next_open_day)
+    if next_open is None:
+        return None
+    next_open_day, new_open_hours = next_open
     day_of_week = next_open_day.strftime('%A').lower()
-    new_open_hours = config.OPEN_HOURS[day_of_week]
     month = next_open_day.strftime("%B").lower()
     day = next_open_day.day
     year = next_open_day.year 
     return (day_of_week, new_open_hours, month, day, year)
 
-def create_connection(db_file):
-    """Create a database connection to the SQLite database
-        specified by the db_file
-    :param 
-        db_file: database file
-    :return: 
-        Connection object or None
-    """
-    db = None
-    try:
-        db = sqlite3.connect(db_file)
-    except Error as e:
-        logger.debug(f"SQLite database connection error: {e}")
-    return db
-
 def get_overlapped_names(book_title_index, book_authors_indexes, book_authors):
     """Get the name overlaps
     :params
@@ -140,7 +153,9 @@ class ActionTellTime(Action):
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
         datetime = next(tracker.get_latest_entity_values('time'), "")
         if datetime:
-            datetime_obj = dateutil.parser.parse(datetime)
+            # the calendar works on the local wall time of the library
+            datetime_obj = dateutil.parser.parse(datetime).replace(tzinfo=None)
+            calendar = opening_calendar.get_calendar()
             day_of_week = datetime_obj.strftime('%A').lower()
             month = datetime_obj.strftime("%B").lower()
             day = datetime_obj.day
@@ -165,7 +180,8 @@ class ActionTellTime(Action):
             be_tense = "is" if future else "was"
 
             # check if the date is open
-            if requested_day in config.YEARLY_HOLIDAYS:
+            open_hours = calendar.open_hours(requested_day)
+            if not open_hours:
                 # requested_day is library holiday
                 dispatcher.utter_message(response="utter_specified_date_closed",
                                          be_tense=be_tense,
@@ -179,7 +195,10 @@ class ActionTellTime(Action):
                     return []
 
                 # if future (including today) suggest next open day
-                next_open_day_of_week, new_open_hours, next_open_month, next_open_day, next_open_year = find_next_open_date(requested_day)
+                next_open = find_next_open_date(requested_day)
+                if next_open is None:
+                    return []
+                next_open_day_of_week, new_open_hours, next_open_month, next_open_day, next_open_year = next_open
 
                 dispatcher.utter_message(response="utter_next_open_date",
                                          day_of_week=next_open_day_of_week,
@@ -189,13 +208,12 @@ class ActionTellTime(Action):
                                          hour_min=format_opentime(new_open_hours))
             else:
                 # requested_day is open
-                open_hours = config.OPEN_HOURS[day_of_week]
                 hour_min_str = format_opentime(open_hours)
                 time_specified = bool(hour | minuite)
                 # use numbers and time, check if number in numbers match with hour or min
                 if time_specified:
                     # check hours if specified and within the opening range
-                    if any([(hour_minuite >= begin_time and hour_minuite <= end_time) for begin_time, end_time in open_hours]):
+                    if calendar.is_open(datetime_obj):
                         # it is open
                         dispatcher.utter_message(response="utter_affirm_open",
                                                  verb_open=verb_open,
@@ -212,28 +230,17 @@ class ActionTellTime(Action):
                                                  year=str(year),
                                                  hour_min=format_time(hour_minuite))
 
-                        # suggest next open date/hour
-                        # first check if any hours open in same day
-                        begin_time = None
-                        end_time = None
-                        found_next = False
-                        for begin_time, end_time in open_hours:
-                            if hour_minuite < begin_time:
-                                found_next = True
-                                break
-
-                        if not found_next:
-                            next_open_day = requested_day
-                            # then check holiday requirement for next day
-                            next_open_day += dt.timedelta(days=1)
-                            day_of_week, new_open_hours, month, day, year = find_next_open_date(next_open_day)
-
+                        # suggest the next opening, later the same day or on the next open date
+                        opening = calendar.next_opening(datetime_obj)
+                        if opening is None:
+                            return []
+                        next_open, next_close = opening
                         dispatcher.utter_message(response="utter_next_open_date",
-                                                 day_of_week=day_of_week,
-                                                 month=month,
-                                                 day=str(day),
-                                                 year=str(year),
-                                                 hour_min=format_opentime([new_open_hours[0]]))
+                                                 day_of_week=next_open.strftime('%A').lower(),
+                                                 month=next_open.strftime("%B").lower(),
+                                                 day=str(next_open.day),
+                                                 year=str(next_open.year),
+                                                 hour_min=format_opentime(((next_open.time(), next_close.time()),)))
                 else:
                     # just reply with date's open day
                     dispatcher.utter_message(response="utter_affirm_open",
@@ -304,14 +311,54 @@ class ValidateContactForm(FormValidationAction):
 
         return {"contact_type" : slot_value}  
         
-class ActionUserInventory(Action):
+class ActionUserInventory(ThreadedActionMixin, Action):
     """Check user inventory."""
     def name(self):
         return "action_user_inventory"
 
-    def run(self, dispatcher: CollectingDispatcher,
+    def run_sync(self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
+        query = self.extract_book_query(tracker)
+        if query is None:
+            dispatcher.utter_message(response="utter_multiple_search_not_supported")
+            return []
+        book_title, book_authors = query
+        intent = tracker.get_intent_of_latest_message()
+
+        with db_pool.get_pool().connection() as (db, book_fts, author_fts):
+            user_id = self.get_user_id(db, dispatcher, tracker)
+            if user_id is None:
+                return []
+            c = db.cursor()
+            if intent == "user_inventory_check_current_borrowing":
+                self.check_current_borrowing(
+                    c, dispatcher, user_id, book_fts, author_fts, book_authors, book_title)
+            elif intent == "user_inventory_check_remaining":
+                self.check_remaining(c, dispatcher, user_id)
+            elif intent == "user_inventory_check_return":
+                self.check_return(c, dispatcher, user_id, book_fts,
+                                  author_fts, book_authors, book_title)
+
+        return []
+
+    def get_user_id(self, db, dispatcher, tracker):
+        """Get the user of the conversation, tell the user if the account is unknown
+        :return
+            int user_id or None
+        """
+        user_id = identity.identities.user_id(db, tracker.sender_id)
+        if user_id is None:
+            dispatcher.utter_message(response="utter_unknown_user")
+        return user_id
+
+    def extract_book_query(self, tracker):
+        """Get the book title and author names of the latest message from its entities
+        :params
+            tracker: Tracker
+        :return
+            (str title or "", list of str author names), None if several titles were given
+        """
         entities = tracker.latest_message['entities']
         book_authors = []
         book_authors_indexes = []
@@ -336,31 +383,8 @@ class ActionUserInventory(Action):
             book_authors = new_book_authors
 
         if len(book_titles) > 1:
-            dispatcher.utter_message(response="utter_multiple_search_not_supported")
-            return []
-
-        book_title = book_titles[0] if book_titles else ""
-        intent = tracker.get_intent_of_latest_message()
-
-        db = create_connection(os.path.join(dir_path, config.DATABASE))
-        c = db.cursor()
-        book_fts = search.FTS4SpellfixSearch(
-            db, './spellfix', table_name="fts4_book")
-        author_fts = search.FTS4SpellfixSearch(
-            db, './spellfix', table_name="fts4_author")
-
-        if intent == "user_inventory_check_current_borrowing":
-            self.check_current_borrowing(
-                c, dispatcher, book_fts, author_fts, book_authors, book_title)
-        elif intent == "user_inventory_check_remaining":
-            self.check_remaining(c, dispatcher)
-        elif intent == "user_inventory_check_return":
-            self.check_return(c, dispatcher, book_fts,
-                              author_fts, book_authors, book_title)
-
-        db.close()
-
-        return []
+            return None
+        return (book_titles[0] if book_titles else ""), book_authors
 
     def get_book_title_id(self, book_fts, book_title_wanted):
         """Given a book title user want, find corresponding book id 
@@ -370,7 +394,7 @@ class ActionUserInventory(Action):
         :return
             int id if found else -1 
         """
-        book_wanted = book_fts.search(book_title_wanted)["results"]
+        book_wanted = book_fts.search(book_title_wanted, limit=1)["results"]
             # only take most relevant book_id
         return book_wanted[0][0] if book_wanted else -1 
 
@@ -385,21 +409,23 @@ class ActionUserInventory(Action):
         authors_wanted_ids = []
         for book_author_wanted in book_authors_wanted:
             author_wanted = author_fts.search(
-                book_author_wanted)["results"]
+                book_author_wanted, limit=1)["results"]
             if author_wanted:
                 # only keep first search result
                 authors_wanted_ids.append(author_wanted[0][0])
         return authors_wanted_ids if authors_wanted_ids else [-1]
 
-    def check_current_borrowing(self, c, dispatcher, book_fts, author_fts, book_authors_wanted, book_title_wanted=""):
+    def check_current_borrowing(self, c, dispatcher, user_id, book_fts, author_fts, book_authors_wanted, book_title_wanted=""):
         """Return user's currently borrowing books information."""
         slots_to_set = []
         c.execute(
-            '''SELECT book_id FROM user_book WHERE user_id = ?''', (config.USER_ID,))
+            queries.USER_BOOK_IDS_QUERY, (user_id,))
         rows = c.fetchall()
         count = len(rows)
 
         if count: # if borrowing
+            metadata = book_lookup.metadata_cache
+            metadata.prefetch(c, [row[0] for row in rows])
             book_wanted_id = self.get_book_title_id(book_fts, book_title_wanted)
             authors_wanted_ids = self.get_book_authors_ids(author_fts, book_authors_wanted)
             
@@ -412,19 +438,14 @@ class ActionUserInventory(Action):
                     books_info_str += "and "
                 # get a book information
                 book_id = row[0]
-                book_title = book_fts.search_by_rowid(book_id)[0]
+                book_title = metadata.title(c, book_id)
                 books_info_str += book_title + " by "
-                # get all authors' ids
-                c.execute(
-                    "SELECT author_id FROM book_authors WHERE book_id=?", (book_id,))
-                author_ids = [aid[0] for aid in c.fetchall()]
 
                 # get authors' name
                 author_names = []
                 author_id_match = False
 
-                for j, author_id in enumerate(author_ids):
-                    author_name = author_fts.search_by_rowid(author_id)[0]
+                for author_id, author_name in metadata.authors(c, book_id):
                     author_names.append(author_name)
                     # as long as one author name matches, then mark as true
                     if book_authors_wanted and author_id in authors_wanted_ids:
@@ -477,10 +498,10 @@ class ActionUserInventory(Action):
             dispatcher.utter_message(
                 response="utter_user_inventory_tell_no_borrowing")
     
-    def check_remaining(self, c, dispatcher):
+    def check_remaining(self, c, dispatcher, user_id):
         """Return message with number of remaining books for user."""
         c.execute(
-            '''SELECT COUNT(*) FROM user_book WHERE user_id = ?''', (config.USER_ID,))
+            queries.USER_BOOK_COUNT_QUERY, (user_id,))
         count = c.fetchone()
         if count:
             count = count[0]
@@ -495,13 +516,15 @@ class ActionUserInventory(Action):
             dispatcher.utter_message(
                 response="utter_user_inventory_tell_no_remaining")
 
-    def check_return(self, c, dispatcher, book_fts, author_fts, book_authors_wanted, book_title_wanted=""):
+    def check_return(self, c, dispatcher, user_id, book_fts, author_fts, book_authors_wanted, book_title_wanted=""):
         """Return user's return dates for the currently borrowing books."""
         c.execute(
-            '''SELECT book_id, return_date FROM user_book WHERE user_id = ? AND is_returned = 0''', (config.USER_ID,))
+            queries.USER_LOANS_QUERY, (user_id,))
         rows = c.fetchall()
 
         if len(rows):
+            metadata = book_lookup.metadata_cache
+            metadata.prefetch(c, [row[0] for row in rows])
             book_wanted_id = self.get_book_title_id(book_fts, book_title_wanted)
             authors_wanted_ids = self.get_book_authors_ids(author_fts, book_authors_wanted)
 
@@ -514,30 +537,23 @@ class ActionUserInventory(Action):
                     books_return_dates += "and "
                 # get book information
                 book_id = row[0]
-                book_title = book_fts.search_by_rowid(book_id)[0]
-                # get all author's ids
-                c.execute(
-                    "SELECT author_id FROM book_authors WHERE book_id=?", (book_id,))
-                author_ids = [aid[0] for aid in c.fetchall()]
+                book_title = metadata.title(c, book_id)
 
                 # get authors' name
                 author_names = []
                 author_id_match = False
 
-                for j, author_id in enumerate(author_ids):
-                    author_name = author_fts.search_by_rowid(author_id)[0]
+                for author_id, author_name in metadata.authors(c, book_id):
                     author_names.append(author_name)
                     if book_authors_wanted and author_id in authors_wanted_ids:
                         author_id_match = True
 
                 author_names_str = ' and '.join(author_names)
 
-                # assuming return-date is formatted as mm/dd/YY
-                month, day, year = row[1].split("/")
-                month, day, year = int(month), int(day), int(year)
-                date = dt.datetime(year, month, day)
+                # return_date is a date ordinal
+                date = dt.date.fromordinal(row[1])
 
-                suffix = get_suffix(day)
+                suffix = get_suffix(date.day)
 
                 # prints "Monday March 3rd, 2022"
                 book_return_str = book_title + " by " + author_names_str + \
@@ -586,56 +602,144 @@ class ActionUserInventory(Action):
             dispatcher.utter_message(
                 response="utter_user_inventory_tell_no_borrowing")
 
-class ActionPerformBorrow(Action):
+class ActionReturnBook(ActionUserInventory):
+    """Return or renew the user's borrowed books named in the latest message."""
+    action_timeout = None
+
+    def name(self):
+        return "action_return_book"
+
+    def run_sync(self, dispatcher: CollectingDispatcher,
+            tracker: Tracker,
+            domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
+        query = self.extract_book_query(tracker)
+        if query is None:
+            dispatcher.utter_message(response="utter_multiple_search_not_supported")
+            return []
+        book_title, book_authors = query
+        renew = tracker.get_intent_of_latest_message() == "renew_book"
+
+        with db_pool.get_pool().connection() as (db, book_fts, author_fts):
+            user_id = self.get_user_id(db, dispatcher, tracker)
+            if user_id is None:
+                return []
+            c = db.cursor()
+            c.execute(queries.USER_LOANS_QUERY, (user_id,))
+            loan_ids = [row[0] for row in c.fetchall()]
+            if not loan_ids: # nothing in inventory
+                dispatcher.utter_message(response="utter_user_inventory_tell_no_borrowing")
+                return []
+
+            metadata = book_lookup.metadata_cache
+            metadata.prefetch(c, loan_ids)
+            if book_title or book_authors:
+                book_ids = self.match_loans(c, book_fts, author_fts, loan_ids, book_title, book_authors)
+            elif len(loan_ids) == 1: # the only borrowed book
+                book_ids = loan_ids
+            else: # list the borrowed books, the user asks again naming one of them
+                operation = "renew" if renew else "return"
+                dispatcher.utter_message(response="utter_ask_which_borrowed_book", num_books=len(loan_ids),
+                                         books_info=self.format_books(c, loan_ids), operation=operation,
+                                         example=f"{operation} {metadata.title(c, loan_ids[0])}")
+                return []
+
+            if not book_ids:
+                dispatcher.utter_message(response="utter_borrowed_book_no_match")
+                return []
+
+            try:
+                if renew:
+                    results = borrow.renew_books(db, user_id, book_ids)
+                else:
+                    results = borrow.return_books(db, book_ids, user_id)
+            except (sqlite3.Error, borrow.BusyError) as er:
+                logger.debug(f"Error at updating the loans in user_book table: {er}")
+                dispatcher.utter_message(text="Sorry, something went wrong. Please try again in a moment.")
+                return []
+            done = [bid for bid, result in results.items() if result.status in (borrow.RENEWED, borrow.RETURNED)]
+            if not done: # returned in the meantime, eg. at the desk
+                dispatcher.utter_message(response="utter_borrowed_book_no_match")
+                return []
+            books_info = self.format_books(c, done)
+
+        if renew:
+            return_date = results[done[0]].return_date
+            suffix = get_suffix(return_date.day)
+            dispatcher.utter_message(response="utter_renew_complete", books_info=books_info,
+                                     return_date=return_date.strftime(f"%A %B %-d{suffix}, %Y"))
+        else:
+            dispatcher.utter_message(response="utter_return_complete", books_info=books_info)
+        return []
+
+    def match_loans(self, c, book_fts, author_fts, loan_ids, book_title_wanted, book_authors_wanted):
+        """Find the borrowed books matching the requested title and author names
+        :params
+            c: sqlite3.Cursor
+            loan_ids: list of int borrowed book ids
+            book_title_wanted: str
+            book_authors_wanted: list of str
+        :return
+            list of int book ids
+        """
+        metadata = book_lookup.metadata_cache
+        matched = loan_ids
+        if book_title_wanted:
+            title_ids = {b[0] for b in book_fts.search(book_title_wanted, rowids=loan_ids)["results"]}
+            matched = [bid for bid in matched if bid in title_ids]
+        if book_authors_wanted:
+            loan_author_ids = {aid for bid in loan_ids for aid, _ in metadata.authors(c, bid)}
+            authors_wanted_ids = set()
+            for author_wanted in book_authors_wanted:
+                authors_wanted_ids.update(a[0] for a in author_fts.search(
+                    author_wanted, limit=1, rowids=loan_author_ids)["results"])
+            matched = [bid for bid in matched if any(aid in authors_wanted_ids for aid, _ in metadata.authors(c, bid))]
+        return matched
+
+    def format_books(self, c, book_ids):
+        """Format the title and authors of books as "A by B, and C by D"."""
+        metadata = book_lookup.metadata_cache
+        books = [metadata.title(c, bid) + " by " + " and ".join(name for _, name in metadata.authors(c, bid))
+                 for bid in book_ids]
+        if len(books) == 1:
+            return books[0]
+        return ", ".join(books[:-1]) + ", and " + books[-1]
+
+class ActionPerformBorrow(ThreadedActionMixin, Action):
     """Validate if the wanted book is available and perform borrowing for the user."""
+    action_timeout = None
+
     def name(self) -> Text:
         return "action_perform_borrow"
 
-    def run(self, dispatcher: CollectingDispatcher,
+    def run_sync(self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
-        found_books = tracker.get_slot("found_books") if not tracker.get_slot("is_ambiguous") else tracker.get_slot("narrowed_found_books")
+        found_books = slot_found_books(tracker)
         selected_list_index = tracker.get_slot("selected_list_index")
 
-        db = create_connection(os.path.join(dir_path, config.DATABASE))
-        c = db.cursor()
-
-        c.execute(
-            '''SELECT COUNT(*) FROM user_book WHERE user_id = ?''', (config.USER_ID,))
-        num_borrowing = c.fetchone()
-        if num_borrowing:
-            num_borrowing = num_borrowing[0]
-        else:
-            num_borrowing = 0 
-        
         selected_book = found_books[selected_list_index]
-        # check availability
-        c.execute(
-            '''SELECT user_id, return_date FROM user_book WHERE book_id = ? AND is_returned = 0''', (selected_book[0],))
-        record = c.fetchone()
-
-        if num_borrowing == config.MAX_BOOK: # max-ed the borrowing limit already
-            dispatcher.utter_message(response=f"utter_cannot_borrow")   
-        elif record: # someone is borrowing 
-            if record[0] == config.USER_ID:  # actually the user itself is already borrowing it
-                dispatcher.utter_message(
-                    response="utter_tell_you_already_borrowing")
-            else:
-                dispatcher.utter_message(response="utter_tell_not_available")
-        else:
-            current_date_temp = dt.datetime.date(dt.datetime.now())
-            return_date = current_date_temp + \
-                dt.timedelta(days=config.MAX_RENT_DAYS)
+        with db_pool.get_pool().connection() as (db, _, _):
+            user_id = identity.identities.user_id(db, tracker.sender_id)
+            if user_id is None:
+                dispatcher.utter_message(response="utter_unknown_user")
+                return [FollowupAction("action_reset_slots")]
             try:
-                c.execute("""INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?,?,?,?)""",
-                          (config.USER_ID, selected_book[0], return_date.strftime("%m/%d/%Y"), 0))
-                db.commit()
-            except sqlite3.Error as er:
-                logger.debug('SQLite error: %s' % (' '.join(er.args)))
-                logger.debug(f"Error at inserting book record into user_book table")
+                result = borrow.borrow(db, user_id, selected_book.book_id)
+            except (sqlite3.Error, borrow.BusyError) as er:
+                logger.debug(f"Error at inserting book record into user_book table: {er}")
                 dispatcher.utter_message(text="Sorry, something went wrong. Failed to perform the borrowing. Please start again.")
+                return [FollowupAction("action_reset_slots")]
 
-            book_info = selected_book[1] + " written by " + ",".join(selected_book[3])
+        if result.status == borrow.LIMIT_REACHED: # max-ed the borrowing limit already
+            dispatcher.utter_message(response=f"utter_cannot_borrow")
+        elif result.status == borrow.ALREADY_BORROWING: # actually the user itself is already borrowing it
+            dispatcher.utter_message(
+                response="utter_tell_you_already_borrowing")
+        elif result.status == borrow.NOT_AVAILABLE: # someone is borrowing
+            dispatcher.utter_message(response="utter_tell_not_available")
+        else:
+            return_date = result.return_date
+            book_info = selected_book.title + " written by " + selected_book.author_str
             suffix = get_suffix(return_date.day)
             dispatcher.utter_message(response="utter_borrow_complete", book_info=book_info,
                                      return_date=return_date.strftime(f"%A %B %-d{suffix}, %Y"))
@@ -664,7 +768,7 @@ class ValidateSelectFromList(FormValidationAction):
                                      tracker: Tracker,
                                      domain: DomainDict) -> Dict[Text, Any]:
         selected_list_index = tracker.get_slot("selected_list_index")
-        found_books = tracker.get_slot("found_books") if not tracker.get_slot("is_ambiguous") else tracker.get_slot("narrowed_found_books")
+        found_books = slot_found_books(tracker)
 
         has_list_selection = tracker.get_slot("has_list_selection")
         # make sure the index is within valid range. Only can be invalid by either initial trigger of the form, ambiguous index selected (due to title name multiple match), or invalid index (wrong ordinal, non existing title/authors)
@@ -682,7 +786,7 @@ class ValidateSelectFromList(FormValidationAction):
             for i, record in enumerate(found_books):
                 if i == len(found_books) - 1:
                     multiple_books_info += " and "
-                multiple_books_info += record[1] + " written by " + ",".join(record[-1]) + ", "
+                multiple_books_info += record.title + " written by " + record.author_str + ", "
             dispatcher.utter_message(
                 response="utter_found_multiple_book", num_books=len(found_books), multiple_books_info=multiple_books_info)
         else: # valid index
@@ -727,9 +831,7 @@ class ValidateSelectFromList(FormValidationAction):
         narrowed_found_books = []
 
         extracted_slots = dict()
-        found_books = tracker.get_slot("found_books")
-        if tracker.get_slot("is_ambiguous"):
-            found_books = tracker.get_slot("narrowed_found_books")
+        found_books = slot_found_books(tracker)
         # book_authors and book_title has precedence over ordinal
         if tracker.get_slot("form_flag"): # denotes as first step is running for this form
             extracted_slots["form_flag"] = False
@@ -741,9 +843,9 @@ class ValidateSelectFromList(FormValidationAction):
             matched_book_title_indexes = []
             matched_book_author_indexes = []
             for i, record in enumerate(found_books):
-                if book_wanted_title in record[1].lower():
+                if book_wanted_title in record.title.lower():
                     matched_book_title_indexes.append(i)    
-                if set(authors_wanted_names).issubset(set(i.lower() for i in record[-1])):
+                if set(authors_wanted_names).issubset(set(i.lower() for i in record.author_names)):
                     matched_book_author_indexes.append(i)
 
             # as soon as one matched by given book_title then ignore authors
@@ -787,11 +889,18 @@ class ValidateSelectFromList(FormValidationAction):
 
         return extracted_slots
 
-class ActionSearchBook(Action):
+class ActionSearchBook(ThreadedActionMixin, Action):
     """ Performs action for the search book."""
     def name(self) -> Text:
         return "action_search_book"
 
+    def timeout_events(self, tracker: Tracker) -> List[Dict[Text, Any]]:
+        """Clear the search and its results, as after a search finding nothing."""
+        return [SlotSet("book_title", None), SlotSet("book_authors", None), SlotSet("wrong_author_names", None),
+                SlotSet("book_info_prefilled", False), SlotSet("found_books", None),
+                SlotSet("selected_list_index", None), SlotSet("has_found_book", False),
+                SlotSet("has_list_selection", False)]
+
     def utter_found_no_book(self, dispatcher, book_title_wanted, author_names_wanted):
         """Tell user as no matched book existed in the library database.
         :params
@@ -804,7 +913,7 @@ class ActionSearchBook(Action):
         book_info += " and ".join(author_names_wanted) if author_names_wanted else ""
         dispatcher.utter_message(response="utter_found_no_book", book_info=book_info)
 
-    def run(self, dispatcher: CollectingDispatcher,
+    def run_sync(self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
         book_title_wanted = tracker.get_slot("book_title")
@@ -814,135 +923,62 @@ class ActionSearchBook(Action):
         if author_names_wanted == ["skip"]:
             author_names_wanted = []
 
-        db = create_connection(os.path.join(dir_path, config.DATABASE))
-        c = db.cursor()
-        book_fts = search.FTS4SpellfixSearch(db, './spellfix', table_name="fts4_book")
-        author_fts = search.FTS4SpellfixSearch(db, './spellfix', table_name="fts4_author")
+        with db_pool.get_pool().connection() as (db, book_fts, author_fts):
+            c = db.cursor()
 
-        book_title_ids = []
-        book_results = book_fts.search(book_title_wanted)["results"]
-        for b in book_results:  # getting all the possible title results
-            book_title_ids.append(b[0])
+            book_title_ids = []
+            book_results = book_fts.search(book_title_wanted, limit=config.SEARCH_CANDIDATES)["results"]
+            for b in book_results:  # getting all the possible title results
+                book_title_ids.append(b[0])
 
-        authors_wanted_ids = []
-        for author_name in author_names_wanted:
-            author_wanted = author_fts.search(author_name)["results"]
-            author_ids = []
-            for a in author_wanted:
-                author_ids.append(a[0])
-            if author_ids:
-                authors_wanted_ids.append(author_ids)
-
-        if len(authors_wanted_ids) > 1:
-            # list of tuples of all possible combinations
-            authors_wanted_ids = list(itertools.product(*authors_wanted_ids))
-        elif authors_wanted_ids:
-            authors_wanted_ids = [[aid] for aid in authors_wanted_ids[0]]
-
-        columns = [
-            "book_id",
-            "title",
-            "author_ids",
-            "author_names"
-        ]
-        BookRecord = namedtuple("BookRecord", columns)
-        found_books = []
+            authors_wanted_ids = []
+            for author_name in author_names_wanted:
+                author_wanted = author_fts.search(author_name, limit=config.SEARCH_CANDIDATES)["results"]
+                author_ids = []
+                for a in author_wanted:
+                    author_ids.append(a[0])
+                if author_ids:
+                    authors_wanted_ids.append(author_ids)
+
+            found_books = []
         
-        if book_title_wanted and author_names_wanted and (not book_title_ids or not authors_wanted_ids):
-            # both fields were provided but either one was not found from our database
-            logger.debug(f"no found books for a given search query even though ")
-            pass
-        elif book_title_ids:  # book_title_ids given
-            # TODO(akazawan): Find a better way to perform the query
-            query = """SELECT bi.book_id, ftsb.title, GROUP_CONCAT(ban.author_id), GROUP_CONCAT(ban.author_name)
-                       FROM book_info bi 
-                       INNER JOIN 
-                       (
-                           SELECT * FROM book_authors ba 
-                           INNER JOIN fts4_author ftsa 
-                           ON ba.author_id=ftsa.rowid
-                        ) ban 
-                        ON bi.book_id=ban.book_id
-                        INNER JOIN fts4_book ftsb
-                        ON bi.book_id=ftsb.rowid
-                        WHERE bi.book_id = %s"""
-
-            book_records = []
-            for bid in book_title_ids:
-                row = c.execute(format_query_list(1, query), (bid,))
-                if row:
-                    book_records.append(c.fetchone())
-
-            unique_title_author = set()
-            for record in book_records:
-                *binfo, aids, anames = record
-                aids = list(map(int, aids.split(",")))
-                anames = anames.split(",")
-                # only keep unique records by title and author names (disgard uniquness of the book's format for now)
-                if (record[1], tuple(aids)) in unique_title_author:
-                    continue
-                unique_title_author.add((record[1], tuple(aids)))
-                if authors_wanted_ids:  # both slots exist
-                    for pair in authors_wanted_ids: # check if given book info is containing user requested authors 
-                        if set(pair).issubset(set(aids)):
-                            found_books.append(BookRecord(*(binfo + [aids, anames])))
-                else:
-                    found_books.append(BookRecord(*(binfo + [aids, anames])))
-        elif authors_wanted_ids:  # only authors names were given
-            # TODO(akazawan): Need a better way to extract book record with matching tuple of author_ids. Multiple queries vs one query
-            query = """SELECT bi.book_id, ftsb.title, ban.author_id, ban.author_name
-                       FROM book_info bi 
-                       INNER JOIN 
-                       (
-                           SELECT * FROM book_authors ba 
-                           INNER JOIN fts4_author fts 
-                           ON ba.author_id=fts.rowid
-                        ) ban 
-                        ON bi.book_id=ban.book_id
-                        INNER JOIN fts4_book ftsb
-                        ON bi.book_id=ftsb.rowid
-                        WHERE ban.author_id in (%s)"""
-
-            unique_title_author = set()
-            for pair in authors_wanted_ids:
-                # get the book_ids that match one
-                c.execute(format_query_list(len(pair), query), pair)
-                possible_books = c.fetchall()
-                sort_by_bids = defaultdict(list)
-                for pb in possible_books: # take by unique book_ids
-                    bid = pb[0]
-                    sort_by_bids[bid].append(pb)
-
-                for k, vs in sort_by_bids.items():
-                    aids = {v[-2] for v in vs}
-                    anames = {v[-1] for v in vs}
-                    if (vs[0][1], tuple(aids)) in unique_title_author: # unique (book_title, tuple of author_ids)
-                        continue
-                    unique_title_author.add((vs[0][1], tuple(aids)))
-                    if set(pair).issubset(aids):  # if exact author ids match
-                        found_books.append(BookRecord(
-                            *(list(vs[0][:-2]) + [list(aids), list(anames)])))
+            if book_title_wanted and author_names_wanted and (not book_title_ids or not authors_wanted_ids):
+                # both fields were provided but either one was not found from our database
+                logger.debug(f"no found books for a given search query even though ")
+                pass
+            elif book_title_ids or authors_wanted_ids:
+                # one edition per work, written by one of the matches of every requested author name
+                book_records = book_lookup.search_books(
+                    c, book_ids=book_title_ids, author_groups=authors_wanted_ids,
+                    limit=config.SEARCH_RESULTS)
+                found_books = [BookRecord(*record) for record in book_records]
 
         # utter a result if any
         if found_books:
             # TODO(naamtokyam): Better way to handle resulst more than 4
-            found_books = found_books[:min(len(found_books), 4)]
             if len(found_books) == 1:  # only one match
-                name_str = self.format_author_names_str(found_books[0].author_names)
                 book_info =  found_books[0].title + " written by " + \
-                    name_str
+                    found_books[0].author_str + self.format_availability(found_books[0])
                 dispatcher.utter_message(
                     response="utter_found_one_book", book_info=book_info)
             else:
                 multiple_books_info = ""
+                descriptions = []
                 for i, record in enumerate(found_books):
-                    name_str = self.format_author_names_str(record.author_names)
+                    descriptions.append(record.title + " written by " + \
+                        record.author_str + self.format_availability(record))
                     if i == len(found_books) - 1:
                         multiple_books_info += "and "
-                    multiple_books_info += record.title + " written by " + \
-                        name_str + ", "
+                    multiple_books_info += descriptions[-1] + ", "
+                # the alexa connector also gets the list as data, it reads it out a page at a time.
+                # other channels would show the json message to the user
+                json_message = None
+                if tracker.get_latest_input_channel() == ALEXA_CHANNEL:
+                    json_message = {"found_books": [[record.book_id, description]
+                                                    for record, description in zip(found_books, descriptions)]}
                 dispatcher.utter_message(
-                    response="utter_found_multiple_book", num_books=len(found_books), multiple_books_info=multiple_books_info)
+                    response="utter_found_multiple_book", num_books=len(found_books), multiple_books_info=multiple_books_info,
+                    json_message=json_message)
         else:
             found_books = None
             self.utter_found_no_book(dispatcher, book_title_wanted,author_names_wanted)
@@ -957,6 +993,20 @@ class ActionSearchBook(Action):
 
         return reset_slots + [SlotSet("found_books", found_books), SlotSet("selected_list_index", selected_list_index), SlotSet("has_found_book", has_found_book), SlotSet("has_list_selection", has_list_selection)] #+ addtional_actions
 
+    def format_availability(self, record):
+        """Tell when a found book is checked out
+        :params
+            record: BookRecord
+        :return
+            str, empty if the book is available
+        """
+        if record.is_available:
+            return ""
+        if record.due_date:
+            due_date = dt.date.fromordinal(record.due_date)
+            return f" (checked out until {due_date.strftime('%B')} {due_date.day}{get_suffix(due_date.day)})"
+        return " (checked out)"
+
     def format_author_names_str(self, names):
         """Format given names to proper string
         :params
@@ -964,10 +1014,7 @@ class ActionSearchBook(Action):
         :return 
             formatted str
         """
-        if len(names) == 1:
-            return ",".join(names)
-        else:
-            return  ",".join(names[:-1]) + " and " + names[-1]
+        return book_lookup.format_author_names(names)
 
 class ValidateSearchBookForm(FormValidationAction):
     """Check the validity of book information passed from user."""
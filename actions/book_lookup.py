@@ -0,0 +1,238 @@
+"""
+    Set based book lookups used by the search action.
+    Every function resolves all the candidate ids with one statement, the ids
+    are passed as a json array and expanded with json_each. Results are read
+    from the precomputed book_card table.
+"""
+
+import json
+
+from . import library_config as config
+from .cache import LRUCache
+
+# one denormalized row per book, filled by refresh_book_cards from book_info,
+# book_authors and the fts tables so the actions can render a result without joins
+BOOK_CARD_COLUMNS = "book_card.book_id, book_card.title, book_card.author_ids, book_card.author_names, book_card.author_str"
+
+BOOK_METADATA_QUERY = f"""SELECT {BOOK_CARD_COLUMNS}
+                         FROM json_each(?) ids
+                         CROSS JOIN book_card
+                         ON book_card.book_id=ids.value"""
+
+# the authors of a book keep the order of book_authors, authors missing from fts4_author are left out
+REFRESH_BOOK_CARDS_QUERY = """INSERT OR REPLACE INTO book_card (book_id, work_id, title, author_ids, author_names, author_str)
+                              SELECT book_id, work_id, title,
+                                     json_group_array(author_id) FILTER (WHERE author_name IS NOT NULL),
+                                     json_group_array(author_name) FILTER (WHERE author_name IS NOT NULL),
+                                     format_author_names(json_group_array(author_name) FILTER (WHERE author_name IS NOT NULL))
+                              FROM (SELECT bi.book_id, bi.work_id, ftsb.title, ba.author_id, ftsa.author_name
+                                    FROM book_info bi
+                                    JOIN fts4_book ftsb
+                                    ON ftsb.rowid=bi.book_id
+                                    LEFT JOIN book_authors ba
+                                    ON ba.book_id=bi.book_id
+                                    LEFT JOIN fts4_author ftsa
+                                    ON ftsa.rowid=ba.author_id
+                                    {where}
+                                    ORDER BY bi.book_id, ba.rowid)
+                              GROUP BY book_id"""
+
+# candidate books with their rank, the lower the better
+TITLE_CANDIDATES = """SELECT ids.value AS book_id, ids.key AS rank
+                      FROM json_each(?) ids"""
+
+AUTHOR_CANDIDATES = """SELECT ba.book_id AS book_id, MIN(ids.key) AS rank
+                       FROM json_each(?) ids
+                       CROSS JOIN book_authors ba
+                       ON ba.author_id=ids.value
+                       GROUP BY ba.book_id"""
+
+DEDUP_KEYS = {
+    "work": "COALESCE(book_card.work_id, 'book ' || book_card.book_id)",
+    "title_authors": "book_card.title, book_card.author_ids",
+}
+
+EDITION_RULES = {
+    "available_first": "bi.is_available DESC, candidates.rank",
+    "search_rank": "candidates.rank",
+    "lowest_id": "book_card.book_id",
+}
+
+# keeps one edition per dedup key, the works are ordered by their best ranked edition.
+# author_groups is a json array of author id lists, a book must contain one id of every list.
+# the due date of a borrowed edition comes from the partial index on the active loans.
+SEARCH_BOOKS_QUERY = """WITH candidates AS ({candidates}),
+                        author_groups AS (SELECT value FROM json_each(?)),
+                        editions AS (
+                            SELECT {columns}, bi.is_available,
+                                   ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {edition_order}) AS edition,
+                                   MIN(candidates.rank) OVER (PARTITION BY {key}) AS work_rank
+                            FROM candidates
+                            CROSS JOIN book_card
+                            ON book_card.book_id=candidates.book_id
+                            CROSS JOIN book_info bi
+                            ON bi.book_id=book_card.book_id
+                            WHERE book_card.author_ids != '[]'
+                            AND (? = 0 OR bi.is_available = 1)
+                            AND NOT EXISTS (SELECT 1 FROM author_groups
+                                            WHERE NOT EXISTS (SELECT 1 FROM json_each(author_groups.value) wanted
+                                                              WHERE wanted.value IN (SELECT value FROM json_each(book_card.author_ids)))))
+                        SELECT book_id, title, author_ids, author_names, author_str, is_available,
+                               (SELECT ub.return_date FROM user_book ub
+                                WHERE ub.book_id=editions.book_id AND ub.is_returned = 0) AS due_date
+                        FROM editions
+                        WHERE edition = 1
+                        ORDER BY work_rank
+                        LIMIT ?"""
+
+def search_books_query(by_authors=False, dedup_key=None, edition_rule=None):
+    """Build the search query for title or author candidates.
+    :params
+        by_authors: bool, candidates are the books of author ids instead of book ids
+        dedup_key: key of DEDUP_KEYS, defaults to config.SEARCH_DEDUP_KEY
+        edition_rule: key of EDITION_RULES, defaults to config.SEARCH_EDITION_RULE
+    :return
+        str
+    """
+    return SEARCH_BOOKS_QUERY.format(
+        candidates=AUTHOR_CANDIDATES if by_authors else TITLE_CANDIDATES,
+        columns=BOOK_CARD_COLUMNS,
+        key=DEDUP_KEYS[dedup_key or config.SEARCH_DEDUP_KEY],
+        edition_order=EDITION_RULES[edition_rule or config.SEARCH_EDITION_RULE])
+
+def search_books(c, book_ids=None, author_groups=None, limit=None,
+                 dedup_key=None, edition_rule=None, only_available=None):
+    """Get one card per distinct work among the candidate books in one query.
+    :params
+        c: sqlite3.Cursor
+        book_ids: list of int ranked title matches
+        author_groups: list of lists of int ranked author matches, one list per requested name.
+            Only books written by one author of every list are kept, without book_ids
+            the candidates are the books of these authors
+        limit: int max number of works, None for all
+        dedup_key: key of DEDUP_KEYS
+        edition_rule: key of EDITION_RULES
+        only_available: bool leave out the works without an available edition,
+            defaults to config.SEARCH_ONLY_AVAILABLE
+    :return
+        list of (book_id, title, list of int author ids, list of str author names, author str,
+        bool is available, due date or None) in the order of their best ranked edition
+    """
+    author_groups = [list(group) for group in author_groups or ()]
+    by_authors = not book_ids
+    if by_authors:
+        ids = list(dict.fromkeys(aid for group in author_groups for aid in group))
+    else:
+        ids = list(book_ids)
+    if not ids:
+        return []
+    if only_available is None:
+        only_available = config.SEARCH_ONLY_AVAILABLE
+    c.execute(search_books_query(by_authors, dedup_key, edition_rule),
+              (json.dumps(ids), json.dumps(author_groups), int(only_available), -1 if limit is None else limit))
+    return [_parse_card(row[:5]) + (bool(row[5]), row[6]) for row in c.fetchall()]
+
+def format_author_names(names):
+    """Format author names as "A,B and C".
+    :params
+        names: list of str, or a json array of them
+    :return
+        str
+    """
+    if isinstance(names, str):
+        names = json.loads(names)
+    if len(names) <= 1:
+        return ",".join(names)
+    return ",".join(names[:-1]) + " and " + names[-1]
+
+def refresh_book_cards(conn, book_ids=None, author_ids=None):
+    """Rebuild the book_card rows of the given books and of the books written by
+    the given authors, every card if neither is given. Runs in the caller's transaction.
+    :params
+        conn: sqlite3.Connection
+        book_ids: iterable of int
+        author_ids: iterable of int
+    """
+    conn.create_function("format_author_names", 1, format_author_names, deterministic=True)
+    if book_ids is None and author_ids is None:
+        conn.execute("DELETE FROM book_card")
+        conn.execute(REFRESH_BOOK_CARDS_QUERY.format(where=""))
+        return
+
+    ids = set(book_ids or ())
+    if author_ids:
+        rows = conn.execute("""SELECT ba.book_id FROM json_each(?) ids
+                               CROSS JOIN book_authors ba ON ba.author_id=ids.value""",
+                            (json.dumps(sorted(set(author_ids))),))
+        ids.update(row[0] for row in rows)
+    if not ids:
+        return
+    ids = json.dumps(sorted(ids))
+    conn.execute("DELETE FROM book_card WHERE book_id IN (SELECT value FROM json_each(?))", (ids,))
+    conn.execute(REFRESH_BOOK_CARDS_QUERY.format(where="WHERE bi.book_id IN (SELECT value FROM json_each(?))"),
+                 (ids,))
+
+def _parse_card(row):
+    book_id, title, author_ids, author_names, author_str = row
+    return book_id, title, json.loads(author_ids), json.loads(author_names), author_str
+
+class BookMetadataCache(object):
+    """Read through cache of book titles, author names and book -> authors lists."""
+    def __init__(self, maxsize=10000, ttl=None):
+        self.titles = LRUCache(maxsize, ttl)
+        self.author_names = LRUCache(maxsize, ttl)
+        self.book_authors = LRUCache(maxsize, ttl)
+
+    def prefetch(self, c, book_ids):
+        """Load title and authors of all the given books that are not cached yet, in one query.
+        :params
+            c: sqlite3.Cursor
+            book_ids: list of int
+        """
+        missing = [bid for bid in set(book_ids) if bid not in self.titles or bid not in self.book_authors]
+        if not missing:
+            return
+        c.execute(BOOK_METADATA_QUERY, (json.dumps(missing),))
+        for row in c.fetchall():
+            bid, title, author_ids, author_names, _ = _parse_card(row)
+            self.titles.set(bid, title)
+            self.book_authors.set(bid, author_ids)
+            for author_id, author_name in zip(author_ids, author_names):
+                self.author_names.set(author_id, author_name)
+
+    def title(self, c, book_id):
+        """Title of a book, None if it is not indexed."""
+        title = self.titles.get(book_id)
+        if title is None:
+            self.prefetch(c, [book_id])
+            title = self.titles.get(book_id)
+        return title
+
+    def authors(self, c, book_id):
+        """List of (author_id, author_name) of a book."""
+        author_ids = self.book_authors.get(book_id)
+        if author_ids is None:
+            self.prefetch(c, [book_id])
+            author_ids = self.book_authors.get(book_id, [])
+        return [(aid, self.author_names.get(aid) or self._author_name(c, aid)) for aid in author_ids]
+
+    def _author_name(self, c, author_id):
+        c.execute("SELECT author_name FROM fts4_author WHERE rowid = ?", (author_id,))
+        row = c.fetchone()
+        name = row[0] if row else ""
+        self.author_names.set(author_id, name)
+        return name
+
+    def invalidate(self, book_ids=(), author_ids=()):
+        """Drop the given books and authors, everything if nothing is given."""
+        if not book_ids and not author_ids:
+            self.titles.clear()
+            self.author_names.clear()
+            self.book_authors.clear()
+        for bid in book_ids:
+            self.titles.pop(bid)
+            self.book_authors.pop(bid)
+        for aid in author_ids:
+            self.author_names.pop(aid)
+
+metadata_cache = BookMetadataCache(config.METADATA_CACHE_SIZE, config.METADATA_CACHE_TTL)
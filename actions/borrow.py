@@ -0,0 +1,191 @@
+"""
+    Borrow and return engine.
+    The limit check, the availability check and the write of a loan run in
+    one BEGIN IMMEDIATE transaction, so concurrent users can neither borrow
+    the same copy nor go past the borrowing limit. A busy database is
+    retried with a jittered backoff.
+"""
+
+from collections import namedtuple
+import datetime as dt
+import json
+import logging
+import random
+import sqlite3
+import time
+
+from . import library_config as config
+from . import queries
+
+logger = logging.getLogger(__name__)
+
+# user_book.return_date holds the proleptic gregorian ordinal of the due date, see date.toordinal
+
+BORROWED = "borrowed"
+LIMIT_REACHED = "limit_reached"
+ALREADY_BORROWING = "already_borrowing"
+NOT_AVAILABLE = "not_available"
+RETURNED = "returned"
+RENEWED = "renewed"
+NOT_BORROWING = "not_borrowing"
+
+BorrowResult = namedtuple("BorrowResult", ["status", "return_date"])
+
+class BusyError(Exception):
+    """The database stayed locked through all the retries."""
+
+def is_busy(error):
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error))
+
+def run_write(db, fn, retries=None, backoff=None):
+    """Run fn(cursor) in a BEGIN IMMEDIATE transaction and commit it.
+    The write lock is taken up front, so the reads done by fn cannot be
+    invalidated by another writer before fn writes.
+    :params
+        db: sqlite3.Connection
+        fn: function taking a sqlite3.Cursor
+        retries: int attempts after the first one when the database is busy
+        backoff: float seconds of the first retry delay, doubled every retry
+    :return
+        the result of fn
+    :raise
+        BusyError
+    """
+    retries = config.BORROW_RETRIES if retries is None else retries
+    backoff = config.BORROW_RETRY_BACKOFF if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            c = db.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(c)
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            return result
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            logger.debug(f"Database busy, attempt {attempt + 1} of {retries + 1}: {e}")
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+    raise BusyError(f"Database still locked after {retries + 1} attempts")
+
+def borrow(db, user_id, book_id, max_books=None, rent_days=None, today=None):
+    """Lend a book to a user if the user is below the limit and nobody has it.
+    :params
+        db: sqlite3.Connection
+        user_id: int
+        book_id: int
+        max_books: int borrowing limit, defaults to config.MAX_BOOK
+        rent_days: int loan length, defaults to config.MAX_RENT_DAYS
+        today: datetime.date, defaults to the current date
+    :return
+        BorrowResult, return_date is the due date of the loan of the book if there is one
+    :raise
+        BusyError
+    """
+    max_books = config.MAX_BOOK if max_books is None else max_books
+    rent_days = config.MAX_RENT_DAYS if rent_days is None else rent_days
+    return_date = (today or dt.date.today()) + dt.timedelta(days=rent_days)
+
+    def lend(c):
+        c.execute(queries.USER_BOOK_COUNT_QUERY, (user_id,))
+        if c.fetchone()[0] >= max_books:
+            return BorrowResult(LIMIT_REACHED, None)
+        c.execute(queries.BOOK_LOAN_QUERY, (book_id,))
+        loan = c.fetchone()
+        if loan:
+            status = ALREADY_BORROWING if loan[0] == user_id else NOT_AVAILABLE
+            return BorrowResult(status, dt.date.fromordinal(loan[1]))
+        c.execute(queries.INSERT_LOAN_QUERY, (user_id, book_id, return_date.toordinal()))
+        return BorrowResult(BORROWED, return_date)
+
+    return run_write(db, lend)
+
+def return_books(db, book_ids, user_id=None):
+    """Close the active loans of many books in one transaction, eg. a batch from the desk scanner.
+    Availability follows through the triggers on user_book.
+    :params
+        db: sqlite3.Connection
+        book_ids: iterable of int
+        user_id: int, only close the loans of this user if given
+    :return
+        dict book_id -> BorrowResult with status RETURNED or NOT_BORROWING
+    :raise
+        BusyError
+    """
+    book_ids = list(dict.fromkeys(book_ids))
+
+    def close(c):
+        if user_id is None:
+            c.execute(queries.RETURN_LOANS_QUERY, (json.dumps(book_ids),))
+        else:
+            c.execute(queries.RETURN_USER_LOANS_QUERY, (json.dumps(book_ids), user_id))
+        returned = {row[0] for row in c.fetchall()}
+        return {bid: BorrowResult(RETURNED if bid in returned else NOT_BORROWING, None) for bid in book_ids}
+
+    return run_write(db, close)
+
+def return_book(db, user_id, book_id):
+    """Close the active loan of a book by a user.
+    :return
+        BorrowResult with status RETURNED or NOT_BORROWING
+    """
+    return return_books(db, [book_id], user_id)[book_id]
+
+def renew_books(db, user_id, book_ids, rent_days=None, today=None):
+    """Move the due date of active loans of a user to rent_days from today, in one transaction.
+    :params
+        db: sqlite3.Connection
+        user_id: int
+        book_ids: iterable of int
+        rent_days: int, defaults to config.MAX_RENT_DAYS
+        today: datetime.date, defaults to the current date
+    :return
+        dict book_id -> BorrowResult with status RENEWED or NOT_BORROWING
+    :raise
+        BusyError
+    """
+    book_ids = list(dict.fromkeys(book_ids))
+    rent_days = config.MAX_RENT_DAYS if rent_days is None else rent_days
+    return_date = (today or dt.date.today()) + dt.timedelta(days=rent_days)
+
+    def renew(c):
+        c.execute(queries.RENEW_USER_LOANS_QUERY,
+                  (return_date.toordinal(), json.dumps(book_ids), user_id))
+        renewed = {row[0] for row in c.fetchall()}
+        return {bid: BorrowResult(RENEWED, return_date) if bid in renewed else BorrowResult(NOT_BORROWING, None)
+                for bid in book_ids}
+
+    return run_write(db, renew)
+
+def loans_due_between(db, first, last, user_id=None):
+    """Active loans due from first to last included, in due date order, eg. for a reminder batch.
+    The rows are streamed from the partial index on the due dates of the active loans.
+    :params
+        db: sqlite3.Connection
+        first: datetime.date
+        last: datetime.date
+        user_id: int, only the loans of this user if given
+    :return
+        iterator of (user_id, book_id, datetime.date due date)
+    """
+    if user_id is None:
+        rows = db.execute(queries.LOANS_DUE_BETWEEN_QUERY, (first.toordinal(), last.toordinal()))
+    else:
+        rows = db.execute(queries.USER_LOANS_DUE_BETWEEN_QUERY, (user_id, first.toordinal(), last.toordinal()))
+    for uid, book_id, return_date in rows:
+        yield uid, book_id, dt.date.fromordinal(return_date)
+
+def due_within(db, days, today=None, user_id=None):
+    """Active loans due from today to today + days."""
+    today = today or dt.date.today()
+    return loans_due_between(db, today, today + dt.timedelta(days=days), user_id)
+
+def overdue(db, today=None, user_id=None):
+    """Active loans whose due date is before today."""
+    today = today or dt.date.today()
+    return loans_due_between(db, dt.date.min, today - dt.timedelta(days=1), user_id)
@@ -0,0 +1,77 @@
+"""
+    Bounded thread pool running the blocking database work of the actions,
+    so a slow search does not stall the event loop of the action server.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import logging
+import threading
+from typing import Any, Text, Dict, List
+
+from rasa_sdk import Tracker
+from rasa_sdk.executor import CollectingDispatcher
+
+from . import instrumentation
+from . import library_config as config
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """Return the process wide executor, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.DB_EXECUTOR_WORKERS,
+                                           thread_name_prefix="action-db")
+        return _executor
+
+async def run_blocking(fn, *args, timeout=None):
+    """Run fn(*args) in the executor and wait at most timeout seconds, None to wait until it is done.
+    The context variables of the caller are visible inside fn.
+    :raise
+        asyncio.TimeoutError
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    future = loop.run_in_executor(get_executor(), functools.partial(ctx.run, fn, *args))
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
+
+class ThreadedActionMixin(object):
+    """Mixin for actions doing blocking database work in run_sync.
+    run_sync gets its own dispatcher, its messages are only forwarded if it
+    finishes within action_timeout seconds, otherwise the user is asked to try
+    again and the events of timeout_events are returned.
+    Actions writing to the database set action_timeout to None: the thread
+    cannot be stopped, so a write cut by the timeout would still be committed
+    after the user was told it failed.
+    """
+    action_timeout = config.ACTION_TIMEOUT
+
+    def timeout_events(self, tracker: Tracker) -> List[Dict[Text, Any]]:
+        """Events returned when run_sync does not finish in time."""
+        return []
+
+    async def run(self, dispatcher: CollectingDispatcher,
+                  tracker: Tracker,
+                  domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
+        inner_dispatcher = CollectingDispatcher()
+        token = instrumentation.current_action.set(self.name())
+        try:
+            events = await run_blocking(self.run_sync, inner_dispatcher, tracker, domain,
+                                        timeout=self.action_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.name()} timed out after {self.action_timeout}s")
+            dispatcher.utter_message(text="Sorry, this is taking longer than expected. Please try again in a moment.")
+            return self.timeout_events(tracker)
+        finally:
+            instrumentation.current_action.reset(token)
+        dispatcher.messages.extend(inner_dispatcher.messages)
+        return events
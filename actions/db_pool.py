@@ -0,0 +1,138 @@
+"""
+    Process wide pool of sqlite connections for the action server.
+    Every pooled connection has spellfix loaded, WAL enabled and its own
+    search objects, so an action turn only borrows and returns them.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from . import instrumentation
+from . import library_config as config
+from . import search
+
+logger = logging.getLogger(__name__)
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+PooledConnection = namedtuple("PooledConnection", ["db", "book_fts", "author_fts"])
+
+class ConnectionPool(object):
+    def __init__(self, db_file, spellfix1_path, size, timeout=None):
+        self.db_file = db_file
+        self.spellfix1_path = spellfix1_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open a new connection and prepare the search objects on it."""
+        db = sqlite3.connect(self.db_file, timeout=config.DB_BUSY_TIMEOUT, check_same_thread=False,
+                             factory=instrumentation.InstrumentedConnection)
+        db.execute("PRAGMA journal_mode = WAL")
+        book_fts = search.create_search(db, self.spellfix1_path, "fts4_book", config.SEARCH_BACKEND)
+        author_fts = search.create_search(db, self.spellfix1_path, "fts4_author", config.SEARCH_BACKEND)
+        return PooledConnection(db, book_fts, author_fts)
+
+    def _is_healthy(self, conn):
+        """Check that the connection still answers a trivial query."""
+        try:
+            conn.db.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.debug(f"Dropping broken pooled connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.db.close()
+        except sqlite3.Error:
+            pass
+
+    def acquire(self):
+        """Take an idle connection, open a new one while the pool is not full,
+        otherwise wait up to the pool timeout.
+        :return
+            PooledConnection
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No database connection available after {self.timeout}s")
+
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn):
+        """Give a connection back, rolling back anything left uncommitted."""
+        try:
+            if conn.db.in_transaction:
+                conn.db.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close all the idle connections."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process wide pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(os.path.join(dir_path, config.DATABASE), config.SPELLFIX_PATH,
+                                   config.DB_POOL_SIZE, config.DB_POOL_TIMEOUT)
+            if config.METRICS_PORT:
+                instrumentation.start_metrics_server(config.METRICS_PORT)
+        return _pool
+
+def set_pool(pool):
+    """Replace the process wide pool, eg. to point the actions at another database."""
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, pool
+    if old is not None:
+        old.close()
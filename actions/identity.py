@@ -0,0 +1,75 @@
+"""
+    Maps the sender id of a conversation to a row of the users table.
+    The Alexa connector builds the sender id from the account id and the
+    session id, only the account part identifies the patron. Resolved ids
+    are cached, unknown accounts can be registered on first contact.
+"""
+
+import logging
+
+from . import borrow
+from . import library_config as config
+from . import queries
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# prefix of the Alexa session ids appended to the account id
+ALEXA_SESSION_PREFIX = "amzn1.echo-api.session."
+
+def account_id(sender_id):
+    """Strip the session id the Alexa connector appends to the account id.
+    Sender ids of other channels are returned as they are.
+    """
+    index = sender_id.find(ALEXA_SESSION_PREFIX)
+    return sender_id[:index] if index > 0 else sender_id
+
+class IdentityResolver(object):
+    """Read through cache of account id -> user_id."""
+    def __init__(self, maxsize=100000, ttl=None):
+        self.user_ids = LRUCache(maxsize, ttl)
+
+    def user_id(self, db, sender_id, register=None):
+        """Get the user of a sender id.
+        :params
+            db: sqlite3.Connection
+            sender_id: str
+            register: bool create a user for an unknown account, defaults to config.REGISTER_NEW_USERS
+        :return
+            int user_id, None if the account is unknown and not registered
+        """
+        account = account_id(sender_id)
+        user_id = self.user_ids.get(account)
+        if user_id is not None:
+            return user_id
+
+        row = db.execute(queries.USER_IDENTITY_QUERY, (account,)).fetchone()
+        if row:
+            user_id = row[0]
+        elif config.REGISTER_NEW_USERS if register is None else register:
+            user_id = borrow.run_write(db, lambda c: self._register(c, account))
+        else:
+            return None
+        self.user_ids.set(account, user_id)
+        return user_id
+
+    def _register(self, c, account):
+        # another action server may have registered the account since the lookup
+        c.execute(queries.USER_IDENTITY_QUERY, (account,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+        c.execute(queries.INSERT_USER_QUERY, ("", ""))
+        user_id = c.lastrowid
+        c.execute(queries.INSERT_USER_IDENTITY_QUERY, (account, user_id))
+        logger.info(f"Registered user {user_id} for a new account")
+        return user_id
+
+    def invalidate(self, sender_ids=()):
+        """Drop the given sender ids, everything if nothing is given."""
+        if not sender_ids:
+            self.user_ids.clear()
+        for sender_id in sender_ids:
+            self.user_ids.pop(account_id(sender_id))
+
+identities = IdentityResolver(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
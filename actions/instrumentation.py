@@ -0,0 +1,282 @@
+"""
+    Per statement sql instrumentation for the action server.
+    Connections created with factory=InstrumentedConnection record the
+    statement text, duration, rows returned and the action running it.
+    The statistics can be exported as prometheus text, together with the
+    spellcheck cache counters of actions/search.py, or as json lines.
+"""
+
+from collections import defaultdict, deque
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import library_config as config
+from . import search
+
+logger = logging.getLogger(__name__)
+
+# name of the action running in the current context, set by the actions
+current_action = contextvars.ContextVar("current_action", default="")
+
+# json lines of the finished statements, written to config.QUERY_LOG_FILE by one handler
+query_log = logging.getLogger(__name__ + ".queries")
+query_log.propagate = False
+_query_log_lock = threading.Lock()
+
+def get_query_log():
+    """The statement logger, its file handler is opened on first use."""
+    with _query_log_lock:
+        if not query_log.handlers:
+            handler = logging.FileHandler(config.QUERY_LOG_FILE)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            query_log.addHandler(handler)
+            query_log.setLevel(logging.INFO)
+    return query_log
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+class QueryRecord(object):
+    __slots__ = ("action", "statement", "started", "duration", "rows", "logged")
+
+    def __init__(self, action, statement):
+        self.action = action
+        self.statement = " ".join(statement.split())
+        self.started = time.time()
+        self.duration = 0.0
+        self.rows = 0
+        self.logged = False
+
+    def to_dict(self):
+        return {"time": self.started, "action": self.action, "statement": self.statement,
+                "duration_ms": round(self.duration * 1000, 3), "rows": self.rows}
+
+class QueryStats(object):
+    """Thread safe registry of the recorded statements."""
+    def __init__(self, keep=10000):
+        self._lock = threading.Lock()
+        self.records = deque(maxlen=keep)
+        # records of the cursors collected before being read to the end, finished with the next record
+        self._deferred = deque()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+            self.counts = defaultdict(int)
+            self.seconds = defaultdict(float)
+            self.rows = defaultdict(int)
+            self.histograms = defaultdict(lambda: [0] * len(BUCKETS))
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+            self.counts[record.action] += 1
+
+    def observe(self, record, duration, rows):
+        """Account the time and rows of one execute or fetch call of a record."""
+        with self._lock:
+            self.seconds[record.action] += duration
+            self.rows[record.action] += rows
+        record.duration += duration
+        record.rows += rows
+
+    def finish(self, record=None):
+        """Put the statement into the histogram of its action once it is fully read,
+        together with the deferred ones.
+        """
+        finished = []
+        # popleft is atomic, another thread may empty the deque between a check and the pop
+        while True:
+            try:
+                finished.append(self._deferred.popleft())
+            except IndexError:
+                break
+        if record is not None:
+            finished.append(record)
+        if not finished:
+            return
+        with self._lock:
+            for r in finished:
+                histogram = self.histograms[r.action]
+                for i, bound in enumerate(BUCKETS):
+                    if r.duration <= bound:
+                        histogram[i] += 1
+                        break
+        if config.QUERY_LOG_FILE:
+            log = get_query_log()
+            for r in finished:
+                log.info(json.dumps(r.to_dict()))
+
+    def defer_finish(self, record):
+        """finish for a cursor being garbage collected: no lock and no io, which could
+        deadlock or fail in __del__, the record is finished with the next one.
+        """
+        self._deferred.append(record)
+
+    def to_prometheus(self):
+        """Render the statistics in the prometheus text exposition format."""
+        self.finish()
+        with self._lock:
+            lines = ["# TYPE sqlite_queries_total counter"]
+            lines += [f'sqlite_queries_total{{action="{a}"}} {n}' for a, n in self.counts.items()]
+            lines.append("# TYPE sqlite_rows_total counter")
+            lines += [f'sqlite_rows_total{{action="{a}"}} {n}' for a, n in self.rows.items()]
+            lines.append("# TYPE sqlite_query_seconds histogram")
+            for action, histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'sqlite_query_seconds_bucket{{action="{action}",le="{le}"}} {cumulative}')
+                lines.append(f'sqlite_query_seconds_sum{{action="{action}"}} {self.seconds[action]}')
+                lines.append(f'sqlite_query_seconds_count{{action="{action}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+    def to_jsonl(self):
+        """Render the last recorded statements as json lines."""
+        with self._lock:
+            return "".join(json.dumps(r.to_dict()) + "\n" for r in self.records)
+
+stats = QueryStats()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _record = None
+
+    def _start(self, sql):
+        self._close_record()
+        self._record = QueryRecord(current_action.get(), sql)
+        stats.add(self._record)
+
+    def _observe(self, start, rows):
+        stats.observe(self._record, time.perf_counter() - start, rows)
+        if (config.SLOW_QUERY_MS is not None and not self._record.logged
+                and self._record.duration * 1000 > config.SLOW_QUERY_MS):
+            self._record.logged = True
+            logger.warning(f"Slow query ({self._record.duration * 1000:.1f}ms) "
+                           f"in {self._record.action or 'unknown action'}: {self._record.statement}")
+
+    def _close_record(self):
+        if self._record is not None:
+            stats.finish(self._record)
+            self._record = None
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(start, 0)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(start, 0)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        if self._record is not None:
+            self._observe(start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._record is not None:
+            self._observe(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._record is not None:
+            self._observe(start, len(rows))
+            self._close_record()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._close_record()
+            raise
+        if self._record is not None:
+            self._observe(start, 1)
+        return row
+
+    def close(self):
+        self._close_record()
+        super().close()
+
+    def __del__(self):
+        if self._record is not None:
+            stats.defer_finish(self._record)
+            self._record = None
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors, including the implicit ones of execute, are instrumented."""
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def spellcheck_to_prometheus():
+    """Render the spellcheck cache counters of actions/search.py in the prometheus text exposition format."""
+    spellcheck = search.spellcheck_stats()
+    lines = []
+    for name, kind, value in [("spellcheck_cache_hits_total", "counter", spellcheck["hits"]),
+                              ("spellcheck_cache_misses_total", "counter", spellcheck["misses"]),
+                              ("spellcheck_cache_evictions_total", "counter", spellcheck["evictions"]),
+                              ("spellcheck_cache_size", "gauge", spellcheck["size"]),
+                              ("spellfix_seconds_total", "counter", spellcheck["spellfix_seconds"]),
+                              ("spellcheck_cache_saved_seconds", "gauge", spellcheck["estimated_saved_seconds"])]:
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = stats.to_prometheus() + spellcheck_to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/queries":
+            body, content_type = stats.to_jsonl(), "application/x-ndjson"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port):
+    """Serve /metrics (prometheus) and /queries (json lines) on localhost in a daemon thread."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="sql-metrics", daemon=True).start()
+            logger.info(f"Serving sql metrics on http://127.0.0.1:{port}/metrics")
+    return _server
@@ -2,9 +2,21 @@
 File storing library constant settings
 """
 
-from datetime import time, date
+from datetime import time
 
-USER_ID = 1
+# create a user for a sender id seen for the first time, otherwise the actions refuse it.
+# anyone reaching the assistant would get a library account, only enable it for a closed deployment
+REGISTER_NEW_USERS = False
+
+# accounts mapped to user 1 by the migration adding user_identity, the actions used user 1 for
+# every conversation before. "default" is the sender id of rasa shell, add the Alexa account id
+# (amzn1.ask.account...) of the patron using the assistant
+LEGACY_USER_ACCOUNTS = ("default",)
+
+# entries and seconds kept by the sender id -> user cache
+USER_CACHE_SIZE = 100000
+
+USER_CACHE_TTL = 3600
 
 MAX_BOOK = 5
 
@@ -19,22 +31,25 @@ OPEN_HOURS = {
     "sunday": [(time(14, 0), time(20,45))]
 }
 
-YEAR = 2022
-
+# (month, day) closing days repeated every year
 YEARLY_HOLIDAYS = (
-    date(2021, 12, 24),
-    date(2021, 12, 25),
-    date(2021, 12, 26),
-    date(2021, 12, 31),
-    date(YEAR, 12, 24),
-    date(YEAR, 12, 25),
-    date(YEAR, 12, 26),
-    date(YEAR, 12, 31),
-    date(YEAR+1, 1,1),
-    date(YEAR+1,1,2),
-    date(YEAR+1,1,6)
+    (12, 24),
+    (12, 25),
+    (12, 26),
+    (12, 31),
+    (1, 1),
+    (1, 2),
+    (1, 6)
 )
 
+# single closing days, eg. date(2023, 4, 10)
+EXTRA_HOLIDAYS = ()
+
+# days before and after today covered by the precomputed opening calendar
+CALENDAR_PAST_DAYS = 31
+
+CALENDAR_DAYS = 366
+
 LOCATION = "Via Adalberto Libera, 3 - 38122 Trento, Italy"
 
 EMAIL = "my_library@gmail.com"
@@ -43,4 +58,58 @@ PHONE = "39-0461-283011"
 
 DATABASE = "book_rent_copy.db"
 
-MAX_RENT_DAYS = 14
\ No newline at end of file
+MAX_RENT_DAYS = 14
+SPELLFIX_PATH = "./spellfix"
+
+# "fts4" or "fts5", None to use whatever the database was built with
+SEARCH_BACKEND = None
+
+# number of sqlite connections kept open by the action server
+DB_POOL_SIZE = 4
+
+# seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = 5
+
+# seconds a connection waits for the write lock of another connection
+DB_BUSY_TIMEOUT = 5
+
+# attempts after the first one and seconds of the first delay when a borrow finds the database locked
+BORROW_RETRIES = 3
+
+BORROW_RETRY_BACKOFF = 0.05
+
+# max number of best ranked titles/authors considered by a book search
+SEARCH_CANDIDATES = 100
+
+# max number of distinct works told to the user for a book search
+SEARCH_RESULTS = 4
+
+# editions sharing this key are one search result: "work" (work_id) or "title_authors"
+SEARCH_DEDUP_KEY = "work"
+
+# edition shown for a work: "available_first", "search_rank" or "lowest_id"
+SEARCH_EDITION_RULE = "available_first"
+
+# leave the works without an available copy out of the search results
+SEARCH_ONLY_AVAILABLE = False
+
+# entries and seconds kept by the title/author metadata cache
+METADATA_CACHE_SIZE = 10000
+
+METADATA_CACHE_TTL = 3600
+
+# threads running the database work of the actions, more than DB_POOL_SIZE only makes them wait for a connection
+DB_EXECUTOR_WORKERS = DB_POOL_SIZE
+
+# seconds a read-only action may spend on the database before the user is told to try again,
+# the actions writing loans wait for their transaction (at most BORROW_RETRIES + 1 times DB_BUSY_TIMEOUT)
+ACTION_TIMEOUT = 6
+
+# statements slower than this are logged with a warning, None to disable
+SLOW_QUERY_MS = 100
+
+# port of the local prometheus /metrics endpoint for the sql statistics, None to disable
+METRICS_PORT = None
+
+# file receiving one json line per sql statement, None to disable
+QUERY_LOG_FILE = None
@@ -0,0 +1,126 @@
+"""
+    Precomputed opening calendar of the library.
+    The open intervals of every date in a window around today are built once
+    from the weekly opening hours and the holidays, and flattened into sorted
+    arrays of opening and closing datetimes, so "is it open at t" and "next
+    opening after t" are a binary search. Dates outside the window are
+    computed from the same rules. The yearly holidays are (month, day) pairs,
+    so the calendar rolls forward with the current date.
+"""
+
+import bisect
+import datetime as dt
+
+from . import library_config as config
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# how far the search for the next open date goes outside of the calendar window
+MAX_CLOSED_DAYS = 366
+
+class OpeningCalendar(object):
+    """Open intervals of the dates from first to first + days - 1."""
+    def __init__(self, first, days, open_hours=None, yearly_holidays=None, holidays=None):
+        """
+        :params
+            first: datetime.date first date of the calendar
+            days: int number of dates in the calendar
+            open_hours: dict weekday name -> list of (datetime.time, datetime.time), defaults to config.OPEN_HOURS
+            yearly_holidays: iterable of (month, day), defaults to config.YEARLY_HOLIDAYS
+            holidays: iterable of datetime.date, defaults to config.EXTRA_HOLIDAYS
+        """
+        open_hours = config.OPEN_HOURS if open_hours is None else open_hours
+        self.weekly_hours = tuple(tuple(open_hours.get(name, ())) for name in WEEKDAYS)
+        self.yearly_holidays = frozenset(config.YEARLY_HOLIDAYS if yearly_holidays is None else yearly_holidays)
+        self.holidays = frozenset(config.EXTRA_HOLIDAYS if holidays is None else holidays)
+        self.first = first
+        self.days = days
+
+        # date index -> tuple of the open intervals of the date, empty when closed
+        self.hours = [self.compute_hours(first + dt.timedelta(days=i)) for i in range(days)]
+        self.starts = []
+        self.ends = []
+        for i, intervals in enumerate(self.hours):
+            day = first + dt.timedelta(days=i)
+            for begin_time, end_time in intervals:
+                self.starts.append(dt.datetime.combine(day, begin_time))
+                self.ends.append(dt.datetime.combine(day, end_time))
+
+    def is_holiday(self, day):
+        return day in self.holidays or (day.month, day.day) in self.yearly_holidays
+
+    def compute_hours(self, day):
+        """Open intervals of a date from the rules, without the precomputed window."""
+        if self.is_holiday(day):
+            return ()
+        return self.weekly_hours[day.weekday()]
+
+    def covers(self, day):
+        return 0 <= (day - self.first).days < self.days
+
+    def open_hours(self, day):
+        """Open intervals of a date.
+        :params
+            day: datetime.date
+        :return
+            tuple of (datetime.time, datetime.time), empty when the library is closed
+        """
+        index = (day - self.first).days
+        if 0 <= index < self.days:
+            return self.hours[index]
+        return self.compute_hours(day)
+
+    def is_open(self, t):
+        """Whether the library is open at the datetime t, opening and closing time included."""
+        if not self.covers(t.date()):
+            return any(begin_time <= t.time() <= end_time for begin_time, end_time in self.compute_hours(t.date()))
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i >= 0 and t <= self.ends[i]
+
+    def next_opening(self, t):
+        """First open interval starting after the datetime t.
+        :params
+            t: datetime.datetime
+        :return
+            (datetime.datetime, datetime.datetime) opening and closing or None if closed for MAX_CLOSED_DAYS
+        """
+        if self.covers(t.date()):
+            i = bisect.bisect_right(self.starts, t)
+            if i < len(self.starts):
+                return self.starts[i], self.ends[i]
+            day = self.first + dt.timedelta(days=self.days)
+        else:
+            day = t.date()
+        for _ in range(MAX_CLOSED_DAYS):
+            for begin_time, end_time in self.open_hours(day):
+                start = dt.datetime.combine(day, begin_time)
+                if start > t:
+                    return start, dt.datetime.combine(day, end_time)
+            day += dt.timedelta(days=1)
+        return None
+
+    def next_open_date(self, day):
+        """First date from day included with the library open.
+        :params
+            day: datetime.date
+        :return
+            (datetime.date, tuple of the open intervals) or None if closed for MAX_CLOSED_DAYS
+        """
+        if self.open_hours(day):
+            return day, self.open_hours(day)
+        opening = self.next_opening(dt.datetime.combine(day, dt.time.min))
+        if opening is None:
+            return None
+        return opening[0].date(), self.open_hours(opening[0].date())
+
+_calendar = None
+
+def get_calendar(today=None):
+    """The calendar of the window around today, rebuilt when the date changes."""
+    global _calendar
+    today = today or dt.date.today()
+    first = today - dt.timedelta(days=config.CALENDAR_PAST_DAYS)
+    calendar = _calendar
+    if calendar is None or calendar.first != first:
+        calendar = _calendar = OpeningCalendar(first, config.CALENDAR_PAST_DAYS + config.CALENDAR_DAYS + 1)
+    return calendar
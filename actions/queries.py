@@ -0,0 +1,61 @@
+"""
+    SQL statements run by the custom actions.
+    Kept in one place so utils/database.py can check their query plans.
+"""
+
+from . import book_lookup
+
+USER_IDENTITY_QUERY = """SELECT user_id FROM user_identity WHERE account_id = ?"""
+
+INSERT_USER_QUERY = """INSERT INTO users (user_first_name, user_last_name) VALUES (?, ?)"""
+
+INSERT_USER_IDENTITY_QUERY = """INSERT INTO user_identity (account_id, user_id) VALUES (?, ?)"""
+
+LINK_USER_IDENTITY_QUERY = """INSERT INTO user_identity (account_id, user_id) VALUES (?, ?)
+                              ON CONFLICT(account_id) DO UPDATE SET user_id = excluded.user_id"""
+
+USER_BOOK_IDS_QUERY = """SELECT book_id FROM user_book WHERE user_id = ? AND is_returned = 0"""
+
+USER_BOOK_COUNT_QUERY = """SELECT COUNT(*) FROM user_book WHERE user_id = ? AND is_returned = 0"""
+
+USER_LOANS_QUERY = """SELECT book_id, return_date FROM user_book WHERE user_id = ? AND is_returned = 0"""
+
+BOOK_LOAN_QUERY = """SELECT user_id, return_date FROM user_book WHERE book_id = ? AND is_returned = 0"""
+
+INSERT_LOAN_QUERY = """INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?, ?, ?, 0)"""
+
+# batch writes, the book ids are a json array
+RETURN_LOANS_QUERY = """UPDATE user_book SET is_returned = 1
+                        WHERE is_returned = 0 AND book_id IN (SELECT value FROM json_each(?))
+                        RETURNING book_id"""
+
+RETURN_USER_LOANS_QUERY = """UPDATE user_book SET is_returned = 1
+                             WHERE is_returned = 0 AND book_id IN (SELECT value FROM json_each(?)) AND user_id = ?
+                             RETURNING book_id"""
+
+RENEW_USER_LOANS_QUERY = """UPDATE user_book SET return_date = ?
+                            WHERE is_returned = 0 AND book_id IN (SELECT value FROM json_each(?)) AND user_id = ?
+                            RETURNING book_id"""
+
+# return_date is a date ordinal
+LOANS_DUE_BETWEEN_QUERY = """SELECT user_id, book_id, return_date FROM user_book
+                             WHERE is_returned = 0 AND return_date BETWEEN ? AND ?
+                             ORDER BY return_date"""
+
+USER_LOANS_DUE_BETWEEN_QUERY = """SELECT user_id, book_id, return_date FROM user_book
+                                  WHERE user_id = ? AND is_returned = 0 AND return_date BETWEEN ? AND ?
+                                  ORDER BY return_date"""
+
+# read queries whose plan must use an index on a full size catalog
+INDEXED_QUERIES = [
+    USER_IDENTITY_QUERY,
+    USER_BOOK_IDS_QUERY,
+    USER_BOOK_COUNT_QUERY,
+    USER_LOANS_QUERY,
+    BOOK_LOAN_QUERY,
+    LOANS_DUE_BETWEEN_QUERY,
+    USER_LOANS_DUE_BETWEEN_QUERY,
+    book_lookup.BOOK_METADATA_QUERY,
+    book_lookup.search_books_query(by_authors=False),
+    book_lookup.search_books_query(by_authors=True),
+]
@@ -3,41 +3,94 @@
     ref: https://stackoverflow.com/questions/52803014/sqlite-with-real-full-text-search-and-spelling-mistakes-ftsspellfix-together
 """
 
+import json
+import math
 import re
 import sqlite3
+import struct
 import sys
+import threading
 import time 
 
+from .cache import LRUCache
+
+# term -> spellfix correction (None if spellfix has no suggestion), shared by
+# all the search objects as every table feeds the same spellfix1data
+spellcheck_cache = LRUCache(maxsize=50000, ttl=3600)
+
+_NOT_CACHED = object()
+
+# time spent in spellfix queries and number of terms they looked up, updated by the action threads
+_spellfix_seconds = 0.0
+_spellfix_terms = 0
+_spellfix_lock = threading.Lock()
+
+def spellcheck_stats():
+    """Return the spellcheck cache counters with an estimate of the spellfix
+    time saved, based on the average cost of a term that missed the cache."""
+    stats = spellcheck_cache.stats()
+    with _spellfix_lock:
+        seconds, terms = _spellfix_seconds, _spellfix_terms
+    per_term = seconds / terms if terms else 0.0
+    stats["spellfix_seconds"] = seconds
+    stats["estimated_saved_seconds"] = stats["hits"] * per_term
+    return stats
+
+def bm25(matchinfo, k1=1.2, b=0.75):
+    """Okapi bm25 score of a row from the fts4 matchinfo(table, 'pcnalx') blob.
+    ref: https://www.sqlite.org/fts3.html#appendix_a
+    """
+    info = struct.unpack("@%dI" % (len(matchinfo) // 4), matchinfo)
+    num_phrases, num_cols, num_rows = info[0], info[1], info[2]
+    avg_lengths = info[3:3 + num_cols]
+    lengths = info[3 + num_cols:3 + 2 * num_cols]
+    hits = info[3 + 2 * num_cols:]
+
+    score = 0.0
+    for phrase in range(num_phrases):
+        for col in range(num_cols):
+            base = 3 * (phrase * num_cols + col)
+            hits_this_row, docs_with_hits = hits[base], hits[base + 2]
+            if not hits_this_row:
+                continue
+            idf = math.log((num_rows - docs_with_hits + 0.5) / (docs_with_hits + 0.5) + 1)
+            norm = 1 - b + b * lengths[col] / (avg_lengths[col] or 1)
+            score += idf * hits_this_row * (k1 + 1) / (hits_this_row + k1 * norm)
+    return score
+
 class FTS4SpellfixSearch(object):
-    def __init__(self, conn, spellfix1_path, table_name):
+    def __init__(self, conn, spellfix1_path, table_name, spellcheck_cache=spellcheck_cache):
         self.conn = conn
         self.conn.enable_load_extension(True)
         self.conn.load_extension(spellfix1_path)
+        self.conn.create_function("bm25", 1, bm25, deterministic=True)
         self.table_name = table_name
+        self.spellcheck_cache = spellcheck_cache
 
     def create_schema(self):
+        # execute rather than executescript, which would commit the transaction of rebuild_index
         if self.table_name == "fts4_book":
-            self.conn.executescript(
+            self.conn.execute(
                 """
                 CREATE VIRTUAL TABLE IF NOT EXISTS fts4_book
                     USING fts4(
                         title   TEXT    NOT NULL,
-                );
-                CREATE VIRTUAL TABLE IF NOT EXISTS fts4_book_info_terms
-                    USING fts4aux(fts4_book);
+                )
                 """
             )
+            self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS fts4_book_info_terms
+                    USING fts4aux(fts4_book)""")
         elif self.table_name == "fts4_author":
-            self.conn.executescript(
+            self.conn.execute(
                 """
                 CREATE VIRTUAL TABLE IF NOT EXISTS fts4_author
                     USING fts4(
                         author_name   TEXT    NOT NULL,
-                );
-                CREATE VIRTUAL TABLE IF NOT EXISTS fts4_author_term
-                    USING fts4aux(fts4_author);
+                )
                 """
             )
+            self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS fts4_author_term
+                    USING fts4aux(fts4_author)""")
         
         self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS spellfix1data
                     USING spellfix1""")
@@ -67,8 +120,73 @@ class FTS4SpellfixSearch(object):
                         term not in (SELECT word from spellfix1data_vocab)
                     """
                 )
+        # new vocabulary can change the best correction of any term
+        self.spellcheck_cache.clear()
         # end = time.time()
         # print(f"It took: {end - start}")
+
+    def index_rows(self, rows):
+        """Insert many rows into the fts table without touching the spellfix vocabulary.
+        Meant for bulk loading: the caller owns the transaction and has to call
+        build_vocabulary once all the rows are in.
+        :params
+            rows: iterable of (rowid, text) tuples
+        """
+        if self.table_name == "fts4_book":
+            self.conn.executemany("INSERT INTO fts4_book (rowid, title) VALUES (?, ?)", rows)
+        elif self.table_name == "fts4_author":
+            self.conn.executemany("INSERT INTO fts4_author (rowid, author_name) VALUES (?, ?)", rows)
+
+    def delete_rows(self, rowids):
+        """Remove rows from the fts table, eg. before indexing a new version of them.
+        The caller owns the transaction.
+        :params
+            rowids: iterable of int
+        """
+        self.conn.executemany(f"DELETE FROM {self.table_name} WHERE rowid = ?", ((rowid,) for rowid in rowids))
+
+    def add_vocabulary(self, texts):
+        """Add the terms of the given texts missing from spellfix1data.
+        Unlike build_vocabulary it only looks at the given texts, for incremental
+        updates of a large index. The caller owns the transaction.
+        :params
+            texts: iterable of str, eg. the titles just indexed
+        """
+        terms = {term.lower() for text in texts for term in self._fts4_expr_terms.findall(text)}
+        if terms:
+            self.conn.execute(
+                """
+                INSERT INTO spellfix1data(word)
+                SELECT value FROM json_each(?)
+                WHERE value not in (SELECT word from spellfix1data_vocab)
+                """, (json.dumps(sorted(terms)),))
+        self.spellcheck_cache.clear()
+
+    def build_vocabulary(self):
+        """Merge the fts segments and copy all the new terms into spellfix1data at once."""
+        with self.conn:
+            if self.table_name == "fts4_book":
+                self.conn.execute("INSERT INTO fts4_book(fts4_book) VALUES('optimize')")
+                self.conn.execute(
+                    """
+                    INSERT INTO spellfix1data(word)
+                    SELECT term FROM fts4_book_info_terms
+                    WHERE col=0 AND
+                        term not in (SELECT word from spellfix1data_vocab)
+                    """
+                )
+            elif self.table_name == "fts4_author":
+                self.conn.execute("INSERT INTO fts4_author(fts4_author) VALUES('optimize')")
+                self.conn.execute(
+                    """
+                    INSERT INTO spellfix1data(word)
+                    SELECT term FROM fts4_author_term
+                    WHERE col=0 AND
+                        term not in (SELECT word from spellfix1data_vocab)
+                    """
+                )
+        self.spellcheck_cache.clear()
+
     # fts3 / 4 search expression tokenizer
     # no attempt is made to validate the expression, only
     # to identify valid search terms and extract them.
@@ -81,14 +199,15 @@ class FTS4SpellfixSearch(object):
         # UCS4
         _fts4_expr_terms = re.compile(u"[a-zA-Z0-9\u0080-\U0010FFFF]+")
 
-    def _terms_from_query(self, search_query):
+    @classmethod
+    def _terms_from_query(cls, search_query):
         """Extract search terms from a fts3/4 query
 
         Returns a list of terms and a template such that
         template.format(*terms) reconstructs the original query.
         """
         template, terms, lastpos = [], [], 0
-        for match in self._fts4_expr_terms.finditer(search_query):
+        for match in cls._fts4_expr_terms.finditer(search_query):
             token, (start, end) = match.group(), match.span()
             # full search term
             terms.append(token)
@@ -99,19 +218,45 @@ class FTS4SpellfixSearch(object):
         return terms, "".join(template)
 
     def spellcheck_terms(self, search_query):
-        cursor = self.conn.cursor()
-        base_spellfix = """
-            SELECT :term{0} as term, word FROM spellfix1data
-            WHERE word MATCH :term{0} and top=1
+        """Replace every term of the query by its spellfix correction.
+        Corrections are cached, only the terms missing from the cache are
+        sent to spellfix.
         """
         terms, template = self._terms_from_query(search_query)
-        params = {"term{}".format(i): t for i, t in enumerate(terms, 1)}
-        query = " UNION ".join(
-            [base_spellfix.format(i + 1) for i in range(len(params))]
-        )
-        cursor.execute(query, params)
-        correction_map = dict(cursor)
-        return template.format(*(correction_map.get(t, t.lower()) for t in terms))
+        return template.format(*self.correct_terms(terms))
+
+    def correct_terms(self, terms):
+        """The spellfix correction of every term, the lowercased term if there is none."""
+        correction_map = {}
+        missing = []
+        for t in terms:
+            word = self.spellcheck_cache.get(t, _NOT_CACHED)
+            if word is _NOT_CACHED:
+                missing.append(t)
+            elif word is not None:
+                correction_map[t] = word
+
+        if missing:
+            global _spellfix_seconds, _spellfix_terms
+            start = time.perf_counter()
+            cursor = self.conn.cursor()
+            base_spellfix = """
+                SELECT :term{0} as term, word FROM spellfix1data
+                WHERE word MATCH :term{0} and top=1
+            """
+            params = {"term{}".format(i): t for i, t in enumerate(missing, 1)}
+            query = " UNION ".join(
+                [base_spellfix.format(i + 1) for i in range(len(params))]
+            )
+            cursor.execute(query, params)
+            found = dict(cursor)
+            with _spellfix_lock:
+                _spellfix_seconds += time.perf_counter() - start
+                _spellfix_terms += len(missing)
+            for t in missing:
+                self.spellcheck_cache.set(t, found.get(t))
+            correction_map.update(found)
+        return [correction_map.get(t, t.lower()) for t in terms]
 
     def search_by_rowid(self, rowid):
         cursor = self.conn.cursor()
@@ -122,21 +267,168 @@ class FTS4SpellfixSearch(object):
         cursor.execute(fts_query, (rowid,))
         return cursor.fetchone()
 
-    def search(self, search_query):
+    def search(self, search_query, limit=None, rowids=None):
+        """Full text search with spelling correction, best matches first.
+        :params
+            search_query: str
+            limit: int max number of results, None for all of them
+            rowids: iterable of int, only search these rows if given
+        :return
+            dict with the original terms, the corrected query and the list of (rowid, text)
+        """
         corrected_query = self.spellcheck_terms(search_query)
         cursor = self.conn.cursor()
+        rowid_filter, params = rowids_filter(rowids)
         fts_query = ""
         if self.table_name=="fts4_book":
-            fts_query = "SELECT rowid, * FROM fts4_book WHERE fts4_book MATCH ?"
+            fts_query = f"""SELECT rowid, * FROM fts4_book WHERE fts4_book MATCH ?{rowid_filter}
+                            ORDER BY bm25(matchinfo(fts4_book, 'pcnalx')) DESC, rowid LIMIT ?"""
         elif self.table_name == "fts4_author":
-            fts_query = "SELECT rowid, * FROM fts4_author WHERE fts4_author MATCH ?"
-        cursor.execute(fts_query, (corrected_query,))
+            fts_query = f"""SELECT rowid, * FROM fts4_author WHERE fts4_author MATCH ?{rowid_filter}
+                            ORDER BY bm25(matchinfo(fts4_author, 'pcnalx')) DESC, rowid LIMIT ?"""
+        cursor.execute(fts_query, (corrected_query, *params, -1 if limit is None else limit))
         return {
             "terms": search_query,
             "corrected": corrected_query,
             "results": cursor.fetchall(),
         }
 
+def rowids_filter(rowids):
+    """The condition restricting a MATCH to the given rowids and its parameters, nothing if rowids is None."""
+    if rowids is None:
+        return "", ()
+    return " AND rowid IN (SELECT value FROM json_each(?))", (json.dumps(list(rowids)),)
+
+def fts5_query(terms):
+    """An fts5 MATCH expression requiring all the terms.
+    Every term is an fts5 string, so the punctuation of the user input, like the
+    dots of "j.k." or the quote of "philosopher's", is no fts5 syntax.
+    :params
+        terms: list of str
+    :return
+        str, empty if there are no terms
+    """
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+class FTS5SpellfixSearch(FTS4SpellfixSearch):
+    """Same interface as FTS4SpellfixSearch on top of an fts5 table.
+    The tables keep their fts4_* names so the queries joining them do not
+    change. fts5 ranks with its builtin bm25, keeps a prefix index and only
+    stores column level positions (detail=column), which makes the index
+    smaller. Phrase and NEAR queries are not supported with detail=column.
+    """
+    # table -> (indexed column, fts5vocab table)
+    _tables = {
+        "fts4_book": ("title", "fts4_book_info_terms"),
+        "fts4_author": ("author_name", "fts4_author_term"),
+    }
+
+    def create_schema(self):
+        column, vocab_table = self._tables[self.table_name]
+        self.conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {self.table_name}
+                USING fts5({column}, prefix='2 3', detail=column)""")
+        self.conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {vocab_table}
+                USING fts5vocab({self.table_name}, 'row')""")
+        self.conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS spellfix1data
+                    USING spellfix1""")
+
+    def _insert_vocabulary(self, cursor):
+        _, vocab_table = self._tables[self.table_name]
+        cursor.execute(
+            f"""
+            INSERT INTO spellfix1data(word)
+            SELECT term FROM {vocab_table}
+            WHERE term not in (SELECT word from spellfix1data_vocab)
+            """
+        )
+
+    def index_row(self, row):
+        column, _ = self._tables[self.table_name]
+        cursor = self.conn.cursor()
+        with self.conn:
+            cursor.execute(f"INSERT INTO {self.table_name} (rowid, {column}) VALUES (?, ?)", row)
+            self._insert_vocabulary(cursor)
+        self.spellcheck_cache.clear()
+
+    def index_rows(self, rows):
+        column, _ = self._tables[self.table_name]
+        self.conn.executemany(f"INSERT INTO {self.table_name} (rowid, {column}) VALUES (?, ?)", rows)
+
+    def build_vocabulary(self):
+        with self.conn:
+            self.conn.execute(f"INSERT INTO {self.table_name}({self.table_name}) VALUES('optimize')")
+            self._insert_vocabulary(self.conn.cursor())
+        self.spellcheck_cache.clear()
+
+    def search(self, search_query, limit=None, rowids=None):
+        terms, _ = self._terms_from_query(search_query)
+        corrected_query = fts5_query(self.correct_terms(terms))
+        if not corrected_query:
+            return {"terms": search_query, "corrected": corrected_query, "results": []}
+        cursor = self.conn.cursor()
+        rowid_filter, params = rowids_filter(rowids)
+        cursor.execute(
+            f"""SELECT rowid, * FROM {self.table_name} WHERE {self.table_name} MATCH ?{rowid_filter}
+                ORDER BY rank LIMIT ?""",
+            (corrected_query, *params, -1 if limit is None else limit))
+        return {
+            "terms": search_query,
+            "corrected": corrected_query,
+            "results": cursor.fetchall(),
+        }
+
+SEARCH_BACKENDS = {
+    "fts4": FTS4SpellfixSearch,
+    "fts5": FTS5SpellfixSearch,
+}
+
+def detect_backend(conn, table_name):
+    """Return the backend name of an existing table, fts4 if it does not exist yet."""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table_name,)).fetchone()
+    if row and "fts5" in row[0].lower():
+        return "fts5"
+    return "fts4"
+
+def create_search(conn, spellfix1_path, table_name, backend=None):
+    """Create the search object matching the backend, detected from the database if None."""
+    if backend is None:
+        backend = detect_backend(conn, table_name)
+    return SEARCH_BACKENDS[backend](conn, spellfix1_path, table_name)
+
+def rebuild_index(conn, spellfix1_path, table_name, backend):
+    """Copy an fts table into a new table using the given backend, in one transaction.
+    The spellfix vocabulary stays as it is since the terms do not change.
+    :params
+        conn: sqlite3.Connection
+        spellfix1_path: str
+        table_name: str fts4_book or fts4_author
+        backend: str key of SEARCH_BACKENDS
+    :raise
+        RuntimeError if the copy of an interrupted rebuild is still there
+    """
+    column, vocab_table = FTS5SpellfixSearch._tables[table_name]
+    old_table = table_name + "_old"
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (old_table,)).fetchone():
+        raise RuntimeError(f"{old_table} is left from an interrupted rebuild, "
+                           f"drop it or rename it back to {table_name} first")
+    fts = SEARCH_BACKENDS[backend](conn, spellfix1_path, table_name)
+    # the sqlite3 module does not open a transaction before DDL statements
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN")
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {vocab_table}")
+        conn.execute(f"ALTER TABLE {table_name} RENAME TO {old_table}")
+        fts.create_schema()
+        conn.execute(f"INSERT INTO {table_name} (rowid, {column}) SELECT rowid, {column} FROM {old_table}")
+        conn.execute(f"DROP TABLE {old_table}")
+        conn.execute(f"INSERT INTO {table_name}({table_name}) VALUES('optimize')")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return fts
+
 if __name__ == "__main__":
     from pprint import pprint
     db = sqlite3.connect("testing.db")
@@ -1,5 +1,10 @@
+import asyncio
+from collections import defaultdict
+import functools
 import logging
 import json
+import time
+import aiohttp
 from sanic import Blueprint, response
 from sanic.request import Request
 from typing import Text, Optional, List, Dict, Any
@@ -8,11 +13,242 @@ from rasa.core.channels.channel import UserMessage, OutputChannel
 from rasa.core.channels.channel import InputChannel
 from rasa.core.channels.channel import CollectingOutputChannel
 
+from actions.cache import LRUCache
+
+try:
+    import ujson
+    json_dumps = functools.partial(ujson.dumps, ensure_ascii=False)
+except ImportError:
+    json_dumps = functools.partial(json.dumps, ensure_ascii=False, separators=(",", ":"))
+
 logger = logging.getLogger(__name__)
 
+# Alexa drops the request after 8 seconds, answer before that
+DEFAULT_RESPONSE_TIMEOUT = 6.0
+
+# seconds before the user is told that the answer is on its way
+DEFAULT_PROGRESSIVE_DELAY = 1.5
+
+# conversations kept in the session cache
+DEFAULT_SESSION_CACHE_SIZE = 10000
+
+# seconds a session stays in the cache, the session_expiration_time of domain.yml
+DEFAULT_SESSION_TTL = 3600
+
+REPEAT_INTENTS = ("AMAZON.RepeatIntent",)
+
+REPEAT_TEXTS = ("repeat", "repeat that", "repeat please", "say that again", "say it again",
+                "can you repeat that", "what did you say")
+
+STOP_INTENTS = ("AMAZON.StopIntent", "AMAZON.CancelIntent")
+
+# books read out at a time from a list of found books, the search action tells at most
+# SEARCH_RESULTS of actions/library_config.py so a list only has more pages if that cap is raised
+DEFAULT_LIST_PAGE_SIZE = 4
+
+MORE_INTENTS = ("AMAZON.NextIntent", "AMAZON.MoreIntent")
+
+MORE_TEXTS = ("more", "more please", "say more", "more books", "next", "next ones", "the next ones")
+
+REPROMPT_MESSAGE = "You can ask me about books, your loans or the library."
+
+LIST_REPROMPT_MESSAGE = "Which one would you like? You can say its number."
+
+LIST_MORE_REPROMPT_MESSAGE = "Which one would you like? You can say its number, or more for the next ones."
+
+PROGRESSIVE_MESSAGE = "Give me a moment, I am still searching."
+
+PENDING_MESSAGE = "This is taking longer than usual. Ask me again in a moment and I will tell you what I found."
+
+PENDING_REPROMPT_MESSAGE = "Ask me again and I will tell you what I found."
+
+NO_RESPONSE_MESSAGE = "Sorry, can you repeat that please?"
+
+# intents and request types with their own series in /metrics, the others are counted as "other"
+METRIC_LABELS = frozenset(("LaunchRequest", "SessionEndedRequest", "ReturnUserInput", "AMAZON.HelpIntent",
+                           "AMAZON.NavigateHomeIntent", "AMAZON.FallbackIntent")
+                          + REPEAT_INTENTS + MORE_INTENTS + STOP_INTENTS)
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 6.0, 8.0, float("inf"))
+
+class LatencyStats(object):
+    """Number, duration and timeouts of the webhook requests per Alexa intent.
+    The intent comes from the request, only the ones of labels get their own series.
+    """
+    def __init__(self, labels=METRIC_LABELS):
+        self.labels = labels
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.timeouts = defaultdict(int)
+        self.histograms = defaultdict(lambda: [0] * len(BUCKETS))
+
+    def observe(self, intent, duration, timed_out=False):
+        intent = intent if intent in self.labels else "other"
+        self.counts[intent] += 1
+        self.seconds[intent] += duration
+        self.timeouts[intent] += timed_out
+        histogram = self.histograms[intent]
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                histogram[i] += 1
+                break
+
+    def to_prometheus(self):
+        """Render the counters in the prometheus text exposition format."""
+        lines = ["# TYPE alexa_request_timeouts_total counter"]
+        lines += [f'alexa_request_timeouts_total{{intent="{i}"}} {n}' for i, n in self.timeouts.items()]
+        lines.append("# TYPE alexa_request_seconds histogram")
+        for intent, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'alexa_request_seconds_bucket{{intent="{intent}",le="{le}"}} {cumulative}')
+            lines.append(f'alexa_request_seconds_sum{{intent="{intent}"}} {self.seconds[intent]}')
+            lines.append(f'alexa_request_seconds_count{{intent="{intent}"}} {self.counts[intent]}')
+        return "\n".join(lines) + "\n"
+
+def normalize_text(text):
+    return " ".join(text.lower().strip(" .?!").split())
+
+def page_message(found_books, page, page_size):
+    """Speech for one page of a list of found books, numbered from the start of the list.
+    :params
+        found_books: list of [book_id, description]
+        page: int starting at 0
+        page_size: int
+    :return
+        str
+    """
+    first = page * page_size
+    books = found_books[first:first + page_size]
+    items = ", ".join(f"{first + i + 1}, {description}" for i, (_, description) in enumerate(books))
+    if page == 0:
+        message = f"I found {len(found_books)} books matched. The first {len(books)} are: {items}."
+    elif len(books) == 1:
+        message = f"Book {first + 1} is: {items}."
+    else:
+        message = f"Books {first + 1} to {first + len(books)} are: {items}."
+    remaining = min(len(found_books) - first - len(books), page_size)
+    if remaining == 1:
+        message += " Say more for the next one."
+    elif remaining > 1:
+        message += f" Say more for the next {remaining}."
+    return message
+
+def build_response(message, end_session=False, reprompt=None):
+    """The reply to Alexa, without the fields left at their default.
+    :params
+        message: str spoken to the user
+        end_session: bool
+        reprompt: str spoken if the user stays silent, only while the session is open
+    :return
+        dict
+    """
+    r = {
+        "version": "1.0",
+        "response": {
+            "outputSpeech": {"type": "PlainText", "text": message},
+            "shouldEndSession": end_session,
+        },
+    }
+    if reprompt and not end_session:
+        r["response"]["reprompt"] = {"outputSpeech": {"type": "PlainText", "text": reprompt}}
+    return r
+
+class SessionState(object):
+    """What the connector remembers of a conversation between two turns."""
+    __slots__ = ("sender_id", "user_id", "session_id", "responses", "reprompt", "found_books", "list_page",
+                 "pending")
+
+    def __init__(self, user_id, session_id):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.sender_id = user_id + session_id
+        # texts of the last answer, as spoken to the user
+        self.responses = []
+        self.reprompt = REPROMPT_MESSAGE
+        # [book_id, description] of the last list of found books and the page read out last
+        self.found_books = []
+        self.list_page = 0
+        # (task, output channels, text) of the answer still computed when the budget ran out
+        self.pending = None
+
+    def remember(self, messages, page_size):
+        """Keep the texts and the found books of the messages of an answer.
+        A list of found books longer than page_size replaces the text reading it
+        out with its first page.
+        """
+        self.responses = []
+        self.reprompt = REPROMPT_MESSAGE
+        # "more" only pages through the list of this answer
+        self.found_books = []
+        self.list_page = 0
+        for m in messages:
+            found_books = (m.get("custom") or {}).get("found_books")
+            if found_books is not None:
+                self.found_books = found_books
+                self.list_page = 0
+                self.reprompt = LIST_REPROMPT_MESSAGE
+                if len(found_books) > page_size and self.responses:
+                    self.responses[-1] = page_message(found_books, 0, page_size)
+                    self.reprompt = LIST_MORE_REPROMPT_MESSAGE
+            elif m.get("text"):
+                self.responses.append(m["text"])
+
+    def next_page(self, page_size):
+        """Read out the next page of the last list of found books.
+        :return
+            str or None when the list has no more pages
+        """
+        if (self.list_page + 1) * page_size >= len(self.found_books):
+            return None
+        self.list_page += 1
+        more = (self.list_page + 1) * page_size < len(self.found_books)
+        self.responses = [page_message(self.found_books, self.list_page, page_size)]
+        self.reprompt = LIST_MORE_REPROMPT_MESSAGE if more else LIST_REPROMPT_MESSAGE
+        return self.responses[0]
+
+class ProgressiveResponseSender(object):
+    """Speaks a message while the skill keeps working, through the Alexa progressive response api.
+    https://developer.amazon.com/en-US/docs/alexa/custom-skills/send-the-user-a-progressive-response.html
+    """
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+
+    async def send(self, payload, speech):
+        """Send speech for the request in payload, failures are only logged."""
+        system = payload.get("context", {}).get("System", {})
+        endpoint = system.get("apiEndpoint")
+        token = system.get("apiAccessToken")
+        request_id = payload["request"].get("requestId")
+        if not (endpoint and token and request_id):
+            return
+        body = {"header": {"requestId": request_id},
+                "directive": {"type": "VoicePlayer.Speak", "speech": speech}}
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                async with session.post(f"{endpoint}/v1/directives", json=body,
+                                        headers={"Authorization": f"Bearer {token}"}) as resp:
+                    if resp.status >= 300:
+                        logger.warning(f"Progressive response rejected with status {resp.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Progressive response failed: {e}")
+
+class LocalProgressiveSender(object):
+    """Stand-in for ProgressiveResponseSender keeping the messages, for tests and local runs."""
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, payload, speech):
+        self.sent.append((payload["request"].get("requestId"), speech))
+
+PROGRESSIVE_SENDERS = {"alexa": ProgressiveResponseSender, "local": LocalProgressiveSender}
+
 class AlexaConnector(InputChannel):
     """A custom http input channel for Alexa.
-    You can find more information on custom connectors in the 
+    You can find more information on custom connectors in the
     Rasa docs: https://rasa.com/docs/rasa/user-guide/connectors/custom-connectors/
     """
 
@@ -20,6 +256,111 @@ class AlexaConnector(InputChannel):
     def name(cls):
         return "alexa_assistant"
 
+    @classmethod
+    def from_credentials(cls, credentials):
+        """Read the options of the connector from its section of credentials.yml
+            response_timeout: seconds before the answer is left for the next turn
+            progressive_delay: seconds before the user hears PROGRESSIVE_MESSAGE
+            progressive_response: "alexa", "local" or "none"
+            session_cache_size: conversations kept in the session cache
+            session_ttl: seconds a conversation stays in the session cache
+            list_page_size: books read out at a time from a list of found books
+        """
+        credentials = credentials or {}
+        sender = PROGRESSIVE_SENDERS.get(credentials.get("progressive_response", "alexa"))
+        return cls(response_timeout=float(credentials.get("response_timeout", DEFAULT_RESPONSE_TIMEOUT)),
+                   progressive_delay=float(credentials.get("progressive_delay", DEFAULT_PROGRESSIVE_DELAY)),
+                   progressive_sender=sender() if sender else None,
+                   session_cache_size=int(credentials.get("session_cache_size", DEFAULT_SESSION_CACHE_SIZE)),
+                   session_ttl=float(credentials.get("session_ttl", DEFAULT_SESSION_TTL)),
+                   list_page_size=int(credentials.get("list_page_size", DEFAULT_LIST_PAGE_SIZE)))
+
+    def __init__(self, response_timeout=DEFAULT_RESPONSE_TIMEOUT, progressive_delay=DEFAULT_PROGRESSIVE_DELAY,
+                 progressive_sender=None, session_cache_size=DEFAULT_SESSION_CACHE_SIZE,
+                 session_ttl=DEFAULT_SESSION_TTL, list_page_size=DEFAULT_LIST_PAGE_SIZE):
+        self.response_timeout = response_timeout
+        self.list_page_size = list_page_size
+        self.progressive_delay = progressive_delay
+        self.progressive_sender = progressive_sender
+        self.latency = LatencyStats()
+        # sessionId -> SessionState
+        self.sessions = LRUCache(maxsize=session_cache_size, ttl=session_ttl)
+
+    def get_session(self, payload):
+        """The cached state of the conversation of a request, a new one for an unknown session."""
+        session_object = payload.get("session")
+        session_id = session_object.get('sessionId')
+        state = self.sessions.get(session_id)
+        if state is None:
+            user_id = session_object.get('user',{}).get("userId")
+            state = SessionState(user_id, session_id)
+        # refresh the expiration time and the recency of the session
+        self.sessions.set(session_id, state)
+        return state
+
+    @staticmethod
+    def is_repeat(intent, text):
+        return intent in REPEAT_INTENTS or normalize_text(text) in REPEAT_TEXTS
+
+    @staticmethod
+    def is_more(intent, text):
+        return intent in MORE_INTENTS or normalize_text(text) in MORE_TEXTS
+
+    def is_asked_again(self, state, intent, text):
+        """Whether the user asks again for the pending answer rather than saying something new."""
+        text = normalize_text(text)
+        return not text or self.is_repeat(intent, text) or text == normalize_text(state.pending[2])
+
+    async def ask_assistant(self, on_new_message, payload, state, intent, text):
+        """Get the answer of the assistant within the response budget.
+        If an answer of a previous turn is pending, the user hears it first. Unless
+        the user is only asking for it again, text is sent to the assistant once
+        that answer is done, and both answers are read out together.
+        :return
+            message: str or None if the answer is still not ready
+        """
+        if state.pending is None:
+            out = CollectingOutputChannel()
+            task = asyncio.ensure_future(on_new_message(UserMessage(text, out, sender_id=state.sender_id)))
+            outs = [out]
+        elif self.is_asked_again(state, intent, text):
+            task, outs, text = state.pending
+        else:
+            previous, outs, _ = state.pending
+            out = CollectingOutputChannel()
+            task = asyncio.ensure_future(self.ask_after(previous, on_new_message,
+                                                        UserMessage(text, out, sender_id=state.sender_id)))
+            outs = outs + [out]
+        state.pending = None
+
+        # the task is shielded from the timeouts, the assistant finishes the turn anyway
+        done, _ = await asyncio.wait([task], timeout=self.progressive_delay)
+        if not done and self.progressive_sender is not None:
+            await self.progressive_sender.send(payload, PROGRESSIVE_MESSAGE)
+        if not done:
+            remaining = self.response_timeout - self.progressive_delay
+            done, _ = await asyncio.wait([task], timeout=max(remaining, 0))
+        if not done:
+            state.pending = (task, outs, text)
+            return None
+
+        try:
+            task.result()
+        except Exception:
+            logger.exception("The assistant failed to answer")
+        # extract the text from Rasa's response
+        state.remember([m for out in outs for m in out.messages], self.list_page_size)
+        if len(state.responses) > 0:
+            return " ".join(state.responses)
+        logger.error("No Response returned from the Assistant")
+        return NO_RESPONSE_MESSAGE
+
+    @staticmethod
+    async def ask_after(previous, on_new_message, message):
+        """Send message to the assistant once the previous answer is done, the turns of a conversation are sequential."""
+        await asyncio.wait([previous])
+        await on_new_message(message)
+
     # Sanic blueprint for handling input. The on_new_message
     # function pass the received message to Rasa Core
     # after you have parsed it
@@ -31,74 +372,67 @@ class AlexaConnector(InputChannel):
         async def health(request):
             return response.json({"status": "ok"})
 
+        # latency of the webhook per Alexa intent
+        @alexa_webhook.route("/metrics", methods=["GET"])
+        async def metrics(request):
+            return response.text(self.latency.to_prometheus(), content_type="text/plain; version=0.0.4")
+
         # required route: defines
         @alexa_webhook.route("/webhook", methods=["POST"])
         async def receive(request):
+            start = time.perf_counter()
+            timed_out = False
             # get the json request sent by Alexa
             payload = request.json
             # check to see if the user is trying
             # to launch the skill
             intenttype = payload["request"]["type"]
-            session_object = payload.get("session")
-            session_id = session_object.get('sessionId')
-            user_id = session_object.get('user',{}).get("userId")
-            sender_id = user_id + session_id
+            # get the Alexa-detected intent
+            intent = payload["request"].get("intent", {}).get("name", "")
 
-            # if the user is starting the skill, let them
-            # know it worked & what to do next
+            # launch and stop are answered here, without the assistant
             if intenttype == "LaunchRequest":
+                # if the user is starting the skill, let them
+                # know it worked & what to do next
                 message = "Hello! Welcome to this Rasa-powered Alexa skill. You can start by saying 'hi'."
-                session = "false"
-            else:
-                # get the Alexa-detected intent
-                intent = payload["request"].get("intent", {}).get("name", "")
-
+                end_session = False
+                reprompt = "You can start by saying 'hi'."
+            elif intent in STOP_INTENTS:
                 # makes sure the user isn't trying to
                 # end the skill
-                if intent == "AMAZON.StopIntent":
-                    session = "true"
-                    message = "Talk to you later"
-                else:
-                    # get the user-provided text from
-                    # the slot named "text"
-                    text = payload["request"].get("intent", {}).get("slots",{}).get("text",{}).get("value","")
+                end_session = True
+                reprompt = None
+                message = "Talk to you later"
+                self.sessions.pop(payload.get("session", {}).get("sessionId"))
+            else:
+                state = self.get_session(payload)
 
-                    # initialize output channel
-                    out = CollectingOutputChannel()
+                # get the user-provided text from
+                # the slot named "text"
+                text = payload["request"].get("intent", {}).get("slots",{}).get("text",{}).get("value","")
 
+                message = None
+                if state.pending is None and self.is_repeat(intent, text) and state.responses:
+                    # answered from the session cache, the assistant already has this turn
+                    message = " ".join(state.responses)
+                elif state.pending is None and self.is_more(intent, text):
+                    # the next page of the last list of found books, if any
+                    message = state.next_page(self.list_page_size)
+                if message is None:
                     # send the user message to Rasa &
                     # wait for the response
-                    await on_new_message(UserMessage(text, out,sender_id=sender_id))
-                    # extract the text from Rasa's response
-                    responses = [m["text"] for m in out.messages]
-                    if len(responses) >0:
-                        message = " ".join(responses)
-                    else:
-                        message = "Sorry, can you repeat that please?"
-                        logger.error("No Response returned from the Assistant")
-                    session = "false"
+                    message = await self.ask_assistant(on_new_message, payload, state, intent, text)
+                end_session = False
+                reprompt = state.reprompt
+                if message is None:
+                    timed_out = True
+                    message = PENDING_MESSAGE
+                    reprompt = PENDING_REPROMPT_MESSAGE
+
+            self.latency.observe(intent or intenttype, time.perf_counter() - start, timed_out)
 
             # Send the response generated by Rasa back to Alexa to
             # pass on to the user.
-            r = {
-               "version": "1.0",
-               "sessionAttributes": {"status": "test"},
-               "response": {
-                   "outputSpeech": {
-                       "type": "PlainText",
-                       "text": message,
-                       "playBehavior": "REPLACE_ENQUEUED",
-                   },
-                   "reprompt": {
-                       "outputSpeech": {
-                          "type": "PlainText",
-                          "text": message,
-                          "playBehavior": "REPLACE_ENQUEUED",
-                       }
-                   },
-                   "shouldEndSession": session,
-                   },
-               }
-            return response.json(r)
-
-        return alexa_webhook
\ No newline at end of file
+            return response.json(build_response(message, end_session, reprompt), dumps=json_dumps)
+
+        return alexa_webhook
@@ -0,0 +1,24 @@
+"""
+    Fixtures shared by the tests of the actions.
+"""
+
+import sqlite3
+
+import pytest
+
+from utils import database
+
+@pytest.fixture
+def library_conn():
+    """An in-memory library database at the latest schema version, with users 1 and 2 and books 1 to 5."""
+    conn = sqlite3.connect(":memory:")
+    database.create_tables(conn.cursor())
+    # the migrations read the search tables, their spellfix vocabulary is not needed here
+    conn.execute("CREATE VIRTUAL TABLE fts4_book USING fts4(title)")
+    conn.execute("CREATE VIRTUAL TABLE fts4_author USING fts4(author_name)")
+    database.migrate(conn)
+    conn.executemany("INSERT INTO users (user_first_name, user_last_name) VALUES (?, ?)",
+                     [("john", "doe"), ("amanda", "white")])
+    conn.executemany("INSERT INTO book_info (book_id, is_available) VALUES (?, 1)", [(i,) for i in range(1, 6)])
+    conn.commit()
+    return conn
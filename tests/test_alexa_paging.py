@@ -0,0 +1,42 @@
+"""
+    Tests of the lists of found books read out a page at a time by the Alexa connector.
+    python -m pytest tests
+"""
+
+import pytest
+
+pytest.importorskip("rasa.core.channels.channel")
+
+from alexa_connector import SessionState, LIST_MORE_REPROMPT_MESSAGE, LIST_REPROMPT_MESSAGE, REPROMPT_MESSAGE
+
+def answer(num_books):
+    books = [[i, f"book {i}"] for i in range(1, num_books + 1)]
+    return [{"text": f"I found {num_books} books."}, {"custom": {"found_books": books}}]
+
+def test_first_page_replaces_the_list():
+    state = SessionState("user", "session")
+    state.remember(answer(6), page_size=4)
+    assert state.responses == ["I found 6 books matched. The first 4 are: 1, book 1, 2, book 2, 3, book 3, "
+                               "4, book 4. Say more for the next 2."]
+    assert state.reprompt == LIST_MORE_REPROMPT_MESSAGE
+
+def test_next_page_until_the_end():
+    state = SessionState("user", "session")
+    state.remember(answer(7), page_size=3)
+    assert state.next_page(3) == "Books 4 to 6 are: 4, book 4, 5, book 5, 6, book 6. Say more for the next one."
+    assert state.next_page(3) == "Book 7 is: 7, book 7."
+    assert state.reprompt == LIST_REPROMPT_MESSAGE
+    assert state.next_page(3) is None
+
+def test_short_list_is_read_whole():
+    state = SessionState("user", "session")
+    state.remember(answer(3), page_size=4)
+    assert state.responses == ["I found 3 books."]
+    assert state.next_page(4) is None
+
+def test_answer_without_list_forgets_the_previous_one():
+    state = SessionState("user", "session")
+    state.remember(answer(7), page_size=3)
+    state.remember([{"text": "The library is open."}], page_size=3)
+    assert state.next_page(3) is None
+    assert state.reprompt == REPROMPT_MESSAGE
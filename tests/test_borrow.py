@@ -0,0 +1,38 @@
+"""
+    Tests of the loan transactions.
+    python -m pytest tests
+"""
+
+import datetime as dt
+
+from actions import borrow
+
+TODAY = dt.date(2026, 10, 17)
+
+def test_borrow_sets_due_date(library_conn):
+    result = borrow.borrow(library_conn, 1, 1, rent_days=14, today=TODAY)
+    assert result == borrow.BorrowResult(borrow.BORROWED, TODAY + dt.timedelta(days=14))
+    assert library_conn.execute("SELECT is_available FROM book_info WHERE book_id = 1").fetchone() == (0,)
+
+def test_borrow_limit(library_conn):
+    for book_id in (1, 2):
+        assert borrow.borrow(library_conn, 1, book_id, max_books=2).status == borrow.BORROWED
+    assert borrow.borrow(library_conn, 1, 3, max_books=2) == borrow.BorrowResult(borrow.LIMIT_REACHED, None)
+    # a return frees a place
+    borrow.return_book(library_conn, 1, 1)
+    assert borrow.borrow(library_conn, 1, 3, max_books=2).status == borrow.BORROWED
+
+def test_no_double_lend(library_conn):
+    due = borrow.borrow(library_conn, 1, 1, rent_days=14, today=TODAY).return_date
+    assert borrow.borrow(library_conn, 1, 1) == borrow.BorrowResult(borrow.ALREADY_BORROWING, due)
+    assert borrow.borrow(library_conn, 2, 1) == borrow.BorrowResult(borrow.NOT_AVAILABLE, due)
+    assert library_conn.execute("SELECT COUNT(*) FROM user_book WHERE book_id = 1 AND is_returned = 0").fetchone() == (1,)
+
+def test_return_and_renew(library_conn):
+    borrow.borrow(library_conn, 1, 1, today=TODAY)
+    renewed = borrow.renew_books(library_conn, 1, [1, 2], rent_days=7, today=TODAY + dt.timedelta(days=3))
+    assert renewed[1] == borrow.BorrowResult(borrow.RENEWED, TODAY + dt.timedelta(days=10))
+    assert renewed[2].status == borrow.NOT_BORROWING
+    returned = borrow.return_books(library_conn, [1, 2], 1)
+    assert {bid: result.status for bid, result in returned.items()} == {1: borrow.RETURNED, 2: borrow.NOT_BORROWING}
+    assert borrow.borrow(library_conn, 2, 1).status == borrow.BORROWED
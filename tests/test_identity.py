@@ -0,0 +1,30 @@
+"""
+    Tests of the account to user mapping.
+    python -m pytest tests
+"""
+
+import pytest
+
+from actions import identity
+from utils import database
+
+ACCOUNT = "amzn1.ask.account.TEST"
+
+def test_linked_account_resolves(library_conn):
+    resolver = identity.IdentityResolver()
+    sender_id = ACCOUNT + identity.ALEXA_SESSION_PREFIX + "1"
+    assert resolver.user_id(library_conn, sender_id, register=False) is None
+    assert database.link_account(library_conn, sender_id, 1) == 1
+    assert resolver.user_id(library_conn, ACCOUNT + identity.ALEXA_SESSION_PREFIX + "2", register=False) == 1
+
+def test_link_account_to_new_user(library_conn):
+    user_id = database.link_account(library_conn, ACCOUNT, None, "jane", "roe")
+    assert user_id == 3
+    assert identity.IdentityResolver().user_id(library_conn, ACCOUNT, register=False) == 3
+    # relinking moves the account
+    database.link_account(library_conn, ACCOUNT, 1)
+    assert identity.IdentityResolver().user_id(library_conn, ACCOUNT, register=False) == 1
+
+def test_link_account_unknown_user(library_conn):
+    with pytest.raises(ValueError):
+        database.link_account(library_conn, ACCOUNT, 42)
@@ -0,0 +1,52 @@
+"""
+    Tests of the precomputed opening calendar.
+    python -m pytest tests
+"""
+
+import datetime as dt
+
+from actions.opening_calendar import OpeningCalendar
+
+OPEN_HOURS = {
+    "monday": [(dt.time(5, 0), dt.time(7, 0)), (dt.time(8, 0), dt.time(23, 45))],
+    "tuesday": [(dt.time(8, 0), dt.time(23, 45))],
+    "wednesday": [(dt.time(8, 0), dt.time(23, 45))],
+    "thursday": [(dt.time(8, 0), dt.time(23, 45))],
+    "friday": [(dt.time(8, 0), dt.time(23, 45))],
+    "saturday": [(dt.time(8, 0), dt.time(23, 45))],
+    "sunday": [],
+}
+
+def calendar(days=30, holidays=()):
+    # 2026-10-12 is a monday
+    return OpeningCalendar(dt.date(2026, 10, 12), days, OPEN_HOURS, yearly_holidays=[(12, 25)], holidays=holidays)
+
+def test_next_opening_same_day():
+    assert calendar().next_opening(dt.datetime(2026, 10, 12, 7, 30)) == (
+        dt.datetime(2026, 10, 12, 8, 0), dt.datetime(2026, 10, 12, 23, 45))
+
+def test_next_opening_skips_closed_days():
+    # saturday evening -> sunday closed -> monday early interval
+    assert calendar().next_opening(dt.datetime(2026, 10, 17, 23, 50)) == (
+        dt.datetime(2026, 10, 19, 5, 0), dt.datetime(2026, 10, 19, 7, 0))
+    # a closing day moves the opening to the next day
+    assert calendar(holidays=[dt.date(2026, 10, 19)]).next_opening(dt.datetime(2026, 10, 17, 23, 50))[0] == \
+        dt.datetime(2026, 10, 20, 8, 0)
+
+def test_next_opening_outside_window():
+    # christmas 2026 is a friday, after the window of the calendar
+    assert calendar().next_opening(dt.datetime(2026, 12, 24, 23, 50)) == (
+        dt.datetime(2026, 12, 26, 8, 0), dt.datetime(2026, 12, 26, 23, 45))
+    # from the last day of the window to the first one after it
+    assert calendar(days=6).next_opening(dt.datetime(2026, 10, 17, 23, 50))[0] == dt.datetime(2026, 10, 19, 5, 0)
+
+def test_next_opening_never_open():
+    closed = OpeningCalendar(dt.date(2026, 10, 12), 7, {}, yearly_holidays=(), holidays=())
+    assert closed.next_opening(dt.datetime(2026, 10, 12)) is None
+
+def test_is_open_bounds():
+    cal = calendar()
+    assert cal.is_open(dt.datetime(2026, 10, 12, 8, 0))
+    assert cal.is_open(dt.datetime(2026, 10, 12, 23, 45))
+    assert not cal.is_open(dt.datetime(2026, 10, 12, 7, 30))
+    assert not cal.is_open(dt.datetime(2026, 10, 18, 12, 0))
@@ -0,0 +1,58 @@
+"""
+    Tests of the fts5 queries built from user input.
+    python -m pytest tests
+"""
+
+import sqlite3
+
+import pytest
+
+from actions import library_config as config
+from actions import search
+
+QUERIES = ["j.k. rowling", "philosopher's stone", 'the "best" of', "harry potter: and the (cursed) child"]
+
+@pytest.fixture
+def fts5_conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE VIRTUAL TABLE fts4_book USING fts5(title, prefix='2 3', detail=column)")
+    conn.executemany("INSERT INTO fts4_book (rowid, title) VALUES (?, ?)", [
+        (1, "J.K. Rowling"),
+        (2, "Harry Potter and the Philosopher's Stone"),
+        (3, 'The "Best" of Times'),
+        (4, "Harry Potter: and the (Cursed) Child"),
+    ])
+    return conn
+
+def spellfix_search(conn):
+    """The fts5 search of fts4_book, skips the test without the spellfix extension."""
+    try:
+        fts = search.FTS5SpellfixSearch(conn, config.SPELLFIX_PATH, "fts4_book")
+    except (AttributeError, sqlite3.OperationalError):
+        # AttributeError: python built without enable_load_extension
+        pytest.skip("spellfix extension not available")
+    fts.create_schema()
+    fts.build_vocabulary()
+    return fts
+
+@pytest.mark.parametrize("rowid,query", list(enumerate(QUERIES, 1)))
+def test_fts5_query_matches_punctuated_input(fts5_conn, rowid, query):
+    terms, _ = search.FTS5SpellfixSearch._terms_from_query(query)
+    rows = fts5_conn.execute("SELECT rowid FROM fts4_book WHERE fts4_book MATCH ?",
+                             (search.fts5_query([t.lower() for t in terms]),)).fetchall()
+    assert (rowid,) in rows
+
+def test_fts5_query_escapes_quotes():
+    assert search.fts5_query(['say "hi"', "x"]) == '"say ""hi""" "x"'
+    assert search.fts5_query([]) == ""
+
+def test_fts5_search_with_spellfix(fts5_conn):
+    fts = spellfix_search(fts5_conn)
+    for rowid, query in enumerate(QUERIES, 1):
+        assert rowid in [row[0] for row in fts.search(query)["results"]]
+    assert fts.search("...")["results"] == []
+
+def test_fts5_search_restricted_to_rowids(fts5_conn):
+    fts = spellfix_search(fts5_conn)
+    assert [row[0] for row in fts.search("harry potter", rowids=[4, 1])["results"]] == [4]
+    assert fts.search("harry potter", rowids=[])["results"] == []
@@ -0,0 +1,219 @@
+"""
+    Load test of the database backed custom actions.
+    Builds a synthetic goodreads sized database, then replays tracker payloads
+    shaped like the ones in data/stories/*.yml and tests/test_stories.yml either
+    directly against the action classes or against a running action server.
+
+    python -m utils.benchmark_actions --num_books 1000000 --concurrency 16
+    python -m utils.benchmark_actions --webhook http://localhost:5055/webhook
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+import glob
+import os
+import random
+import sqlite3
+import time
+
+import aiohttp
+import yaml
+
+from actions import actions
+from actions import db_pool
+from actions import identity
+from actions import instrumentation
+from actions import library_config as config
+from rasa_sdk import Tracker
+from rasa_sdk.executor import CollectingDispatcher
+from . import synthetic_db
+
+ACTIONS = {
+    "action_search_book": actions.ActionSearchBook(),
+    "action_user_inventory": actions.ActionUserInventory(),
+    "action_perform_borrow": actions.ActionPerformBorrow(),
+}
+
+INVENTORY_INTENTS = [
+    "user_inventory_check_current_borrowing",
+    "user_inventory_check_remaining",
+    "user_inventory_check_return",
+]
+
+def load_story_slots(paths):
+    """Collect the book_title and book_authors values set in the stories.
+    :return
+        titles: list of str
+        authors: list of list of str
+    """
+    titles, authors = set(), set()
+    for path in paths:
+        with open(path) as f:
+            stories = yaml.safe_load(f).get("stories", [])
+        for story in stories:
+            for step in story.get("steps", []):
+                for slot in step.get("slot_was_set", []):
+                    if not isinstance(slot, dict):
+                        continue
+                    if slot.get("book_title") not in (None, "skip"):
+                        titles.add(str(slot["book_title"]).strip())
+                    names = slot.get("book_authors")
+                    if isinstance(names, str):
+                        names = [names]
+                    if names and names != ["skip"]:
+                        authors.add(tuple(str(name) for name in names))
+    return sorted(titles), [list(a) for a in sorted(authors)]
+
+def tracker_state(sender_id, slots, intent=None, entities=(), text=""):
+    latest_message = {"intent": {"name": intent}, "entities": list(entities), "text": text}
+    if intent:
+        # Tracker.get_intent_of_latest_message reads the ranking, not the intent
+        latest_message["intent"]["confidence"] = 1.0
+        latest_message["intent_ranking"] = [{"name": intent, "confidence": 1.0}]
+    return {
+        "sender_id": sender_id,
+        "slots": slots,
+        "latest_message": latest_message,
+        "events": [],
+        "paused": False,
+        "followup_action": None,
+        "active_loop": {},
+        "latest_action_name": None,
+    }
+
+def make_payloads(conn, story_titles, story_authors, num_requests, seed=0):
+    """Build (action name, tracker state) pairs, half of the searches use the story
+    slot values and half use titles/authors of the synthetic catalog."""
+    rng = random.Random(seed)
+    num_books = conn.execute("SELECT MAX(book_id) FROM book_info").fetchone()[0]
+    num_users = conn.execute("SELECT MAX(user_id) FROM users").fetchone()[0] or 1
+    payloads = []
+    for i in range(num_requests):
+        # shaped like the account + session ids of the Alexa connector
+        sender_id = f"user-{rng.randint(1, num_users)}{identity.ALEXA_SESSION_PREFIX}{i}"
+        action = rng.choice(list(ACTIONS))
+        book_id = rng.randint(1, num_books)
+        title = conn.execute("SELECT title FROM fts4_book WHERE rowid = ?", (book_id,)).fetchone()[0]
+        authors = [a[0] for a in conn.execute(
+            """SELECT ftsa.author_name FROM book_authors ba
+               INNER JOIN fts4_author ftsa ON ftsa.rowid=ba.author_id WHERE ba.book_id = ?""", (book_id,))]
+        author_ids = [a[0] for a in conn.execute("SELECT author_id FROM book_authors WHERE book_id = ?", (book_id,))]
+        if rng.random() < 0.5 and story_titles:
+            title = rng.choice(story_titles)
+            authors = rng.choice(story_authors) if story_authors else []
+
+        if action == "action_search_book":
+            slots = {"book_title": rng.choice([title, title, "skip"]),
+                     "book_authors": rng.choice([authors, [], ["skip"]])}
+            if slots["book_title"] == "skip" and slots["book_authors"] in ([], ["skip"]):
+                slots["book_authors"] = authors
+            payloads.append((action, tracker_state(sender_id, slots)))
+        elif action == "action_user_inventory":
+            text = title
+            entities = [{"entity": "book_title", "value": title, "start": 0, "end": len(title)}]
+            if rng.random() < 0.5:
+                entities, text = [], ""
+            payloads.append((action, tracker_state(sender_id, {}, rng.choice(INVENTORY_INTENTS), entities, text)))
+        else:
+            slots = {"found_books": [[book_id, title, author_ids, authors]], "selected_list_index": 0,
+                     "is_ambiguous": False, "narrowed_found_books": None}
+            payloads.append((action, tracker_state(sender_id, slots)))
+    return payloads
+
+def check_answered(name, state, messages):
+    """Every payload must reach a branch of its action that answers the user,
+    a payload doing nothing would only measure how fast the action returns.
+    :raise
+        RuntimeError
+    """
+    if not messages:
+        raise RuntimeError(f"{name} sent no message for the tracker {state}")
+
+async def replay_direct(payloads, concurrency):
+    """Run the payloads against the action classes in this process.
+    :return
+        dict action name -> list of latencies in seconds
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+
+    async def one(name, state):
+        async with semaphore:
+            dispatcher = CollectingDispatcher()
+            start = time.perf_counter()
+            await ACTIONS[name].run(dispatcher, Tracker.from_dict(state), {})
+            latencies[name].append(time.perf_counter() - start)
+            check_answered(name, state, dispatcher.messages)
+
+    await asyncio.gather(*[one(name, state) for name, state in payloads])
+    return latencies
+
+async def replay_webhook(url, payloads, concurrency):
+    """Post the payloads to the /webhook endpoint of a running action server."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+
+    async with aiohttp.ClientSession() as session:
+        async def one(name, state):
+            body = {"next_action": name, "sender_id": state["sender_id"], "tracker": state,
+                    "domain": {}, "version": "2.8.3"}
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, json=body) as resp:
+                    result = await resp.json()
+                latencies[name].append(time.perf_counter() - start)
+                check_answered(name, state, result.get("responses"))
+
+        await asyncio.gather(*[one(name, state) for name, state in payloads])
+    return latencies
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+def report(latencies, elapsed, query_counts=None):
+    total = sum(len(v) for v in latencies.values())
+    print(f"{total} requests in {elapsed:.2f}s, {total / elapsed:.1f} QPS")
+    print(f"{'action':<24}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql/req':>10}")
+    for name, values in sorted(latencies.items()):
+        sql = f"{query_counts[name] / len(values):.1f}" if query_counts is not None else "-"
+        print(f"{name:<24}{len(values):>6}{percentile(values, 50) * 1000:>10.1f}"
+              f"{percentile(values, 95) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}{sql:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='load test the custom actions')
+    parser.add_argument('--db_file', default="benchmark_actions.db")
+    parser.add_argument('--rebuild', action="store_true", help="rebuild the synthetic database")
+    parser.add_argument('--num_books', type=int, default=200000)
+    parser.add_argument('--num_authors', type=int, default=50000)
+    parser.add_argument('--num_users', type=int, default=1000)
+    parser.add_argument('--num_loans', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--webhook', help="url of a running action server instead of calling the classes")
+    args = parser.parse_args()
+
+    if args.rebuild or not os.path.exists(args.db_file):
+        if os.path.exists(args.db_file):
+            os.remove(args.db_file)
+        conn = synthetic_db.build(args.db_file, args.num_books, args.num_authors, args.num_users,
+                                  args.num_loans, config.SPELLFIX_PATH)
+    else:
+        conn = sqlite3.connect(args.db_file)
+
+    titles, authors = load_story_slots(glob.glob("data/stories/*.yml") + ["tests/test_stories.yml"])
+    payloads = make_payloads(conn, titles, authors, args.requests)
+    conn.close()
+
+    start = time.perf_counter()
+    if args.webhook:
+        latencies = asyncio.run(replay_webhook(args.webhook, payloads, args.concurrency))
+        report(latencies, time.perf_counter() - start)
+    else:
+        db_pool.set_pool(db_pool.ConnectionPool(args.db_file, config.SPELLFIX_PATH,
+                                                config.DB_POOL_SIZE, config.DB_POOL_TIMEOUT))
+        instrumentation.stats.reset()
+        latencies = asyncio.run(replay_direct(payloads, args.concurrency))
+        report(latencies, time.perf_counter() - start, instrumentation.stats.counts)
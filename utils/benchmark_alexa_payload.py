@@ -0,0 +1,60 @@
+"""
+    Size and serialization time of the replies of the Alexa connector.
+    Compares the former reply, with the whole message repeated in the reprompt
+    and serialized with the json module, with the one of build_response, for
+    search results of growing length read out whole or a page at a time.
+    The search action tells at most SEARCH_RESULTS books (4), the lists
+    of 12 and 30 books measured by default only happen with that cap raised.
+
+    python -m utils.benchmark_alexa_payload --books 4 12 30
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from alexa_connector import build_response, json_dumps, page_message, DEFAULT_LIST_PAGE_SIZE, \
+    LIST_MORE_REPROMPT_MESSAGE
+
+def legacy_response(message):
+    """The reply the connector used to send."""
+    speech = {"type": "PlainText", "text": message, "playBehavior": "REPLACE_ENQUEUED"}
+    return {"version": "1.0", "sessionAttributes": {"status": "test"},
+            "response": {"outputSpeech": speech, "reprompt": {"outputSpeech": dict(speech)},
+                         "shouldEndSession": "false"}}
+
+def found_books(num_books, seed=0):
+    rng = random.Random(seed)
+    words = ["the", "night", "garden", "of", "lost", "river", "history", "winter", "city", "stars"]
+    names = ["Jane Austen", "Mary Shelley", "Italo Calvino", "Umberto Eco", "Toni Morrison"]
+    books = []
+    for i in range(num_books):
+        title = " ".join(rng.choice(words) for _ in range(rng.randint(2, 6))).capitalize()
+        authors = " and ".join(rng.sample(names, rng.randint(1, 2)))
+        checked_out = " (checked out until October 31st)" if rng.random() < 0.3 else ""
+        books.append([i + 1, f"{title} written by {authors}{checked_out}"])
+    return books
+
+def measure(reply, dumps, number):
+    body = dumps(reply)
+    seconds = timeit.timeit(lambda: dumps(reply), number=number)
+    return len(body.encode()), seconds / number * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the size and serialization of the alexa replies')
+    parser.add_argument('--books', type=int, nargs="+", default=[1, 4, 12, 30])
+    parser.add_argument('--page_size', type=int, default=DEFAULT_LIST_PAGE_SIZE)
+    parser.add_argument('--number', type=int, default=20000, help="serializations timed per reply")
+    args = parser.parse_args()
+
+    print(f"{'books':>6}{'legacy B':>10}{'legacy us':>11}{'new B':>8}{'new us':>8}{'paged B':>9}{'paged us':>10}")
+    for num_books in args.books:
+        books = found_books(num_books)
+        info = ", ".join(description for _, description in books)
+        message = f"I found {num_books} books matched, and they are {info}, Are any of these books what you are looking for?"
+        legacy = measure(legacy_response(message), json.dumps, args.number)
+        new = measure(build_response(message, reprompt=LIST_MORE_REPROMPT_MESSAGE), json_dumps, args.number)
+        paged = measure(build_response(page_message(books, 0, args.page_size), reprompt=LIST_MORE_REPROMPT_MESSAGE),
+                        json_dumps, args.number)
+        print(f"{num_books:>6}{legacy[0]:>10}{legacy[1]:>11.2f}{new[0]:>8}{new[1]:>8.2f}{paged[0]:>9}{paged[1]:>10.2f}")
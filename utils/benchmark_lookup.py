@@ -0,0 +1,120 @@
+"""
+    Compare the per id book lookups the search action used to run with
+    book_lookup.search_books, the single query the action runs now on the
+    book_card table, keeping one edition per work up to SEARCH_RESULTS.
+    Run from the repository root: python -m utils.benchmark_lookup
+"""
+
+import argparse
+import itertools
+import os
+import sqlite3
+import time
+
+from actions import book_lookup
+from actions import library_config as config
+from . import synthetic_db
+
+LEGACY_BY_ID_QUERY = """SELECT bi.book_id, ftsb.title, GROUP_CONCAT(ban.author_id), GROUP_CONCAT(ban.author_name)
+                        FROM book_info bi
+                        INNER JOIN
+                        (
+                            SELECT * FROM book_authors ba
+                            INNER JOIN fts4_author ftsa
+                            ON ba.author_id=ftsa.rowid
+                        ) ban
+                        ON bi.book_id=ban.book_id
+                        INNER JOIN fts4_book ftsb
+                        ON bi.book_id=ftsb.rowid
+                        WHERE bi.book_id = ?"""
+
+LEGACY_BY_AUTHORS_QUERY = """SELECT bi.book_id, ftsb.title, ban.author_id, ban.author_name
+                             FROM book_info bi
+                             INNER JOIN
+                             (
+                                 SELECT * FROM book_authors ba
+                                 INNER JOIN fts4_author fts
+                                 ON ba.author_id=fts.rowid
+                             ) ban
+                             ON bi.book_id=ban.book_id
+                             INNER JOIN fts4_book ftsb
+                             ON bi.book_id=ftsb.rowid
+                             WHERE ban.author_id in (%s)"""
+
+class CountingCursor(sqlite3.Cursor):
+    """Cursor counting the statements it executes. A trace callback would also
+    count the statements the fts module runs on its shadow tables."""
+    count = 0
+
+    def execute(self, *args):
+        self.count += 1
+        return super().execute(*args)
+
+def legacy_by_ids(c, book_ids):
+    rows = []
+    for bid in book_ids:
+        c.execute(LEGACY_BY_ID_QUERY, (bid,))
+        rows.append(c.fetchone())
+    return rows
+
+def legacy_by_authors(c, authors_wanted_ids):
+    rows = []
+    for pair in authors_wanted_ids:
+        c.execute(LEGACY_BY_AUTHORS_QUERY % ", ".join(["?"] * len(pair)), pair)
+        rows.extend(c.fetchall())
+    return rows
+
+def search_by_title(c, book_ids):
+    """The search of the action for title matches, availability is not filtered to compare the same books."""
+    return book_lookup.search_books(c, book_ids=book_ids, limit=config.SEARCH_RESULTS, only_available=False)
+
+def search_by_authors(c, author_groups):
+    """The search of the action for the matches of every requested author name."""
+    return book_lookup.search_books(c, author_groups=author_groups, limit=config.SEARCH_RESULTS,
+                                    only_available=False)
+
+def measure(conn, fn, *args):
+    """Run fn once and return (number of sql statements, seconds, result)."""
+    c = conn.cursor(factory=CountingCursor)
+    start = time.perf_counter()
+    result = fn(c, *args)
+    elapsed = time.perf_counter() - start
+    return c.count, elapsed, result
+
+def report(name, legacy, searched):
+    print(f"{name}: legacy {legacy[0]} queries {legacy[1] * 1000:.1f}ms {len(legacy[2])} rows | "
+          f"search_books {searched[0]} queries {searched[1] * 1000:.1f}ms {len(searched[2])} works")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the book lookups')
+    parser.add_argument('--db_file', default="benchmark.db")
+    parser.add_argument('--num_books', type=int, default=100000)
+    parser.add_argument('--num_authors', type=int, default=20000)
+    parser.add_argument('--title', default="dracula",
+                        help="title query, the more common the more candidate ids")
+    parser.add_argument('--authors', nargs="+", default=["stephen king", "jane austen"])
+    args = parser.parse_args()
+
+    if os.path.exists(args.db_file):
+        os.remove(args.db_file)
+    conn = synthetic_db.build(args.db_file, args.num_books, args.num_authors)
+
+    book_ids = [r[0] for r in conn.execute("SELECT rowid FROM fts4_book WHERE fts4_book MATCH ?", (args.title,))]
+    legacy = measure(conn, legacy_by_ids, book_ids)
+    searched = measure(conn, search_by_title, book_ids)
+    # the legacy rows still hold every edition, search_books keeps one per work
+    assert {r[0] for r in searched[2]} <= {r[0] for r in legacy[2] if r is not None}
+    report(f"title '{args.title}' ({len(book_ids)} ids)", legacy, searched)
+
+    author_groups = [
+        [r[0] for r in conn.execute("SELECT rowid FROM fts4_author WHERE fts4_author MATCH ?", (name,))]
+        for name in args.authors
+    ]
+    combinations = list(itertools.product(*author_groups))
+    legacy = measure(conn, legacy_by_authors, combinations)
+    searched = measure(conn, search_by_authors, author_groups)
+    # the legacy rows are the books of any author of a combination, search_books
+    # only keeps the books written by a match of every name
+    assert {r[0] for r in searched[2]} <= {r[0] for r in legacy[2]}
+    report(f"authors {args.authors} ({len(combinations)} combinations)", legacy, searched)
+    conn.close()
@@ -4,13 +4,21 @@ Setting up the database.
 
 import sqlite3
 import argparse
-import pathlib
+import contextlib
+from collections import Counter
 import csv
+import datetime as dt
+import json
+import re
+import sys
 import time 
 from tqdm import tqdm 
 
-from . import search
-# import search 
+from actions import book_lookup
+from actions import identity
+from actions import library_config as config
+from actions import queries
+from actions import search
 
 def create_tables(c):
     c.execute("SELECT name FROM sqlite_master WHERE type='table';")
@@ -95,6 +103,209 @@ def create_tables(c):
         FOREIGN KEY(book_id) REFERENCES book_info(book_id)
         )""")
 
+def close_duplicate_loans(conn):
+    """Keep only the oldest active loan of every book, the others are marked returned."""
+    cur = conn.execute("""UPDATE user_book SET is_returned = 1
+                          WHERE is_returned = 0 AND rowid NOT IN (
+                              SELECT MIN(rowid) FROM user_book WHERE is_returned = 0 GROUP BY book_id)""")
+    if cur.rowcount:
+        print(f"closed {cur.rowcount} duplicate active loans")
+
+def convert_return_dates(conn):
+    """Turn the "%m/%d/%Y" strings of user_book.return_date into date ordinals."""
+    def to_ordinal(value):
+        return dt.datetime.strptime(value, "%m/%d/%Y").date().toordinal()
+
+    conn.create_function("mdy_to_ordinal", 1, to_ordinal, deterministic=True)
+    cur = conn.execute("UPDATE user_book SET return_date = mdy_to_ordinal(return_date) WHERE typeof(return_date) = 'text'")
+    print(f"converted {cur.rowcount} return dates")
+
+# book link tables and the columns identifying one of their rows
+LINK_TABLES = {
+    "book_series": ("book_id", "series_id"),
+    "book_authors": ("book_id", "author_id"),
+    "book_similar_books": ("book_id", "similar_book_id"),
+    "genres": ("book_id", "genre"),
+}
+
+def remove_duplicate_links(conn):
+    """Keep the first of the identical rows of the link tables, left by loading a file twice."""
+    for table, columns in LINK_TABLES.items():
+        cur = conn.execute(f"""DELETE FROM {table} WHERE rowid NOT IN (
+                                  SELECT MIN(rowid) FROM {table} GROUP BY {", ".join(columns)})""")
+        if cur.rowcount:
+            print(f"removed {cur.rowcount} duplicate rows from {table}")
+
+def link_account(conn, account_id, user_id=None, first_name="", last_name=""):
+    """Let the owner of an account use the library account of a user, eg. the
+    Alexa account id (amzn1.ask.account...) logged by the connector.
+    An account already linked moves to the given user.
+    :params
+        conn: sqlite3.Connection
+        account_id: str, a sender id of the Alexa connector is reduced to its account id
+        user_id: int existing user, None to create a user with the given names
+    :return
+        int user_id
+    :raise
+        ValueError if the user does not exist
+    """
+    account = identity.account_id(account_id)
+    with conn:
+        if user_id is None:
+            user_id = conn.execute(queries.INSERT_USER_QUERY, (first_name, last_name)).lastrowid
+        elif not conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+            raise ValueError(f"There is no user {user_id}")
+        conn.execute(queries.LINK_USER_IDENTITY_QUERY, (account, user_id))
+    return user_id
+
+def seed_legacy_accounts(conn):
+    """Map the accounts of config.LEGACY_USER_ACCOUNTS to user 1, the user of every
+    conversation before the user_identity table, if that user exists."""
+    if conn.execute("SELECT 1 FROM users WHERE user_id = 1").fetchone():
+        conn.executemany("INSERT OR IGNORE INTO user_identity (account_id, user_id) VALUES (?, 1)",
+                         ((account,) for account in config.LEGACY_USER_ACCOUNTS))
+
+# schema migrations applied in order, the last applied version is stored in PRAGMA user_version.
+# a step is either a sql statement or a function taking the connection.
+MIGRATIONS = [
+    (1, "secondary indexes", [
+        """CREATE INDEX IF NOT EXISTS idx_user_book_user
+            ON user_book(user_id, is_returned, book_id, return_date)""",
+        """CREATE INDEX IF NOT EXISTS idx_user_book_book_active
+            ON user_book(book_id, user_id, return_date) WHERE is_returned = 0""",
+        "CREATE INDEX IF NOT EXISTS idx_book_authors_book ON book_authors(book_id, author_id)",
+        "CREATE INDEX IF NOT EXISTS idx_book_authors_author ON book_authors(author_id, book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_book_series_book ON book_series(book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_book_similar_books_book ON book_similar_books(book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_genres_book ON genres(book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_genres_genre ON genres(genre, book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_book_info_work ON book_info(work_id)",
+    ]),
+    (2, "book_card table", [
+        """CREATE TABLE IF NOT EXISTS book_card (
+            book_id INTEGER NOT NULL PRIMARY KEY,
+            work_id INTEGER,
+            title TEXT NOT NULL,
+            author_ids TEXT NOT NULL,
+            author_names TEXT NOT NULL,
+            author_str TEXT NOT NULL
+            )""",
+        "CREATE INDEX IF NOT EXISTS idx_book_card_work ON book_card(work_id)",
+        book_lookup.refresh_book_cards,
+    ]),
+    (3, "book availability maintained on borrow and return", [
+        """UPDATE book_info SET is_available = NOT EXISTS (
+            SELECT 1 FROM user_book ub WHERE ub.book_id = book_info.book_id AND ub.is_returned = 0)""",
+        """CREATE TRIGGER IF NOT EXISTS trg_user_book_borrow
+            AFTER INSERT ON user_book WHEN NEW.is_returned = 0
+            BEGIN
+                UPDATE book_info SET is_available = 0 WHERE book_id = NEW.book_id;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_user_book_return
+            AFTER UPDATE OF book_id, is_returned ON user_book
+            BEGIN
+                UPDATE book_info SET is_available = NOT EXISTS (
+                    SELECT 1 FROM user_book ub WHERE ub.book_id = book_info.book_id AND ub.is_returned = 0)
+                WHERE book_id IN (OLD.book_id, NEW.book_id);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_user_book_delete
+            AFTER DELETE ON user_book WHEN OLD.is_returned = 0
+            BEGIN
+                UPDATE book_info SET is_available = NOT EXISTS (
+                    SELECT 1 FROM user_book ub WHERE ub.book_id = book_info.book_id AND ub.is_returned = 0)
+                WHERE book_id = OLD.book_id;
+            END""",
+    ]),
+    (4, "at most one active loan per book", [
+        close_duplicate_loans,
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_user_book_one_active_loan
+            ON user_book(book_id) WHERE is_returned = 0""",
+    ]),
+    (5, "return_date as a date ordinal", [
+        convert_return_dates,
+        """CREATE INDEX IF NOT EXISTS idx_user_book_due
+            ON user_book(return_date, user_id, book_id, is_returned) WHERE is_returned = 0""",
+    ]),
+    (6, "sender account to user mapping", [
+        """CREATE TABLE IF NOT EXISTS user_identity (
+            account_id TEXT NOT NULL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+            ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_user_identity_user ON user_identity(user_id)",
+    ]),
+    (7, "no duplicate book links", [
+        remove_duplicate_links,
+        # the unique indexes replace the ones on their leading columns
+        "DROP INDEX IF EXISTS idx_book_authors_book",
+        "DROP INDEX IF EXISTS idx_book_series_book",
+        "DROP INDEX IF EXISTS idx_book_similar_books_book",
+        "DROP INDEX IF EXISTS idx_genres_book",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_book_authors_unique ON book_authors(book_id, author_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_book_series_unique ON book_series(book_id, series_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_book_similar_books_unique ON book_similar_books(book_id, similar_book_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_genres_unique ON genres(book_id, genre)",
+    ]),
+    (8, "accounts of the former single user", [
+        seed_legacy_accounts,
+    ]),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn, target=None):
+    """Apply the pending migrations, each one in its own transaction.
+    :params
+        conn: sqlite3.Connection
+        target: int version to stop at, None for the latest
+    """
+    current = schema_version(conn)
+    for version, description, steps in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        print(f"-- MIGRATING TO VERSION {version}: {description} --")
+        # the sqlite3 module does not open a transaction before DDL statements, BEGIN
+        # makes the steps and the new user_version one unit
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    conn.execute("ANALYZE")
+    print(f"schema version {schema_version(conn)}")
+
+def check_query_plans(conn):
+    """Run EXPLAIN QUERY PLAN on every query of the actions and report the ones
+    scanning a whole table or relying on an automatic index.
+    :return
+        True if all the queries use an index
+    """
+    all_indexed = True
+    for query in queries.INDEXED_QUERIES:
+        params = [1] * query.count("?")
+        plan = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+        # scanning a common table expression or a subquery only reads rows already searched
+        derived = {f"SCAN {name}" for name in re.findall(r"(\w+) AS \(", query)}
+        bad = [step for step in plan
+               if (step.startswith("SCAN ") and "VIRTUAL TABLE" not in step
+                   and step not in derived and not step.startswith("SCAN (subquery"))
+               or "AUTOMATIC" in step]
+        all_indexed = all_indexed and not bad
+        print(("FAIL" if bad else "OK") + ": " + " ".join(query.split()))
+        for step in plan:
+            print(f"    {step}")
+    return all_indexed
+
 def print_tables(c):
     print(" -- PRING TABLES -- ")
 
@@ -173,15 +384,398 @@ def print_tables(c):
         print(row)
     return 
 
+def read_tsv(file_path):
+    """Read a tsv file exported by format_data.py
+    :params
+        file_path: str
+    :return
+        generator of dict column -> value (None for empty fields), None for malformed rows
+    """
+    with open(file_path) as file:
+        csvreader = csv.reader(file, delimiter="\t")
+        header = next(csvreader)
+        for row in csvreader:
+            if len(row) != len(header):
+                yield None
+                continue
+            yield {col: row[i] if row[i] else None for i, col in enumerate(header)}
+
+# links already in the table are skipped, loading a file twice adds no duplicates
+LINK_INSERTS = {table: f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES (?, ?)"
+                for table, columns in LINK_TABLES.items()}
+
+def report_throughput(count, start):
+    """Print the number of processed rows and the rows per second since start."""
+    elapsed = time.time() - start
+    rate = count / elapsed if elapsed else 0
+    print(f"{count} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+@contextlib.contextmanager
+def fast_load_pragmas(conn):
+    """Load without syncing and with the rollback journal in memory, then restore
+    the previous modes. journal_mode is stored in the database file, left as
+    MEMORY it would take the WAL mode away from the action servers.
+    """
+    synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    try:
+        yield
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+
+def bulk_load(conn, args, book_fts, author_fts):
+    """Load a tsv file in batches.
+    Rows are buffered per statement and written with executemany, one transaction
+    per batch. The spellfix vocabulary is filled once at the end instead of after
+    every single fts row.
+    :params
+        conn: sqlite3.Connection
+        args: parsed command line arguments
+        book_fts: search.FTS4SpellfixSearch for titles
+        author_fts: search.FTS4SpellfixSearch for authors
+    """
+    with fast_load_pragmas(conn):
+        batches = {
+            "book_fts": [],
+            "author_fts": [],
+            "book_info": [],
+            "book_series": [],
+            "book_authors": [],
+            "book_similar_books": [],
+            "series": [],
+            "works": [],
+            "genres": [],
+        }
+        statements = {
+            "book_info": """INSERT INTO book_info (isbn, format, publisher, num_pages, country_code,
+                            language_code, publication_year, book_id, work_id, is_available)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            "book_series": LINK_INSERTS["book_series"],
+            "book_authors": LINK_INSERTS["book_authors"],
+            "book_similar_books": LINK_INSERTS["book_similar_books"],
+            "series": "INSERT INTO series (series_id, series_works_count, primary_work_count, title) VALUES (?, ?, ?, ?)",
+            "works": "INSERT INTO works (original_publication_year, work_id, original_title) VALUES (?, ?, ?)",
+            "genres": LINK_INSERTS["genres"],
+        }
+
+        def flush():
+            with conn:
+                book_fts.index_rows(batches["book_fts"])
+                author_fts.index_rows(batches["author_fts"])
+                for name, query in statements.items():
+                    if batches[name]:
+                        conn.executemany(query, batches[name])
+            for batch in batches.values():
+                batch.clear()
+
+        count = 0
+        mismatches = 0
+        start = time.time()
+        for values in read_tsv(args.file_path):
+            count += 1
+            if values is None:
+                mismatches += 1
+                continue
+
+            if args.table_name == "book_info":
+                if not values["title"]:
+                    mismatches += 1
+                    continue
+                batches["book_fts"].append((values["book_id"], values["title"]))
+                batches["book_info"].append(
+                    (values["isbn"], values["format"], values["publisher"], values["num_pages"], values["country_code"],
+                     values["language_code"], values["publication_year"], values["book_id"], values["work_id"], 1))
+                if values["series"]:
+                    batches["book_series"].extend((values["book_id"], sid) for sid in values["series"].split(" "))
+                if values["authors"]:
+                    batches["book_authors"].extend((values["book_id"], aid) for aid in values["authors"].split(" "))
+                if values["similar_books"]:
+                    batches["book_similar_books"].extend(
+                        (values["book_id"], bid) for bid in values["similar_books"].split(" "))
+            elif args.table_name == "authors":
+                batches["author_fts"].append((values["author_id"], values["name"]))
+            elif args.table_name == "series":
+                batches["series"].append(
+                    (values["series_id"], values["series_works_count"], values["primary_work_count"], values["title"]))
+            elif args.table_name == "works":
+                batches["works"].append((values["original_publication_year"], values["work_id"], values["original_title"]))
+            elif args.table_name == "genres":
+                if values["genres"]:
+                    batches["genres"].extend(
+                        (values["book_id"], genre) for genre in values["genres"].replace(",", "").split(" "))
+
+            if count % args.batch_size == 0:
+                flush()
+                report_throughput(count, start)
+
+        flush()
+        print("-- BUILDING SPELLFIX VOCABULARY --")
+        if args.table_name == "book_info":
+            book_fts.build_vocabulary()
+        elif args.table_name == "authors":
+            author_fts.build_vocabulary()
+
+        report_throughput(count, start)
+        print(f"Total {count}. Mismatch {mismatches}. Percentage {mismatches / max(count, 1) * 100}")
+
+# delta fields of a book listing ids, and the link table they fill
+BOOK_LINK_FIELDS = {
+    "series": "book_series",
+    "authors": "book_authors",
+    "similar_books": "book_similar_books",
+}
+
+CATALOG_UPSERTS = {
+    # is_available of a known book is left to the loan triggers
+    "book_info": """INSERT INTO book_info (isbn, format, publisher, num_pages, country_code,
+                    language_code, publication_year, book_id, work_id, is_available)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                    ON CONFLICT(book_id) DO UPDATE SET
+                        isbn = excluded.isbn, format = excluded.format, publisher = excluded.publisher,
+                        num_pages = excluded.num_pages, country_code = excluded.country_code,
+                        language_code = excluded.language_code, publication_year = excluded.publication_year,
+                        work_id = excluded.work_id""",
+    "series": """INSERT INTO series (series_id, series_works_count, primary_work_count, title) VALUES (?, ?, ?, ?)
+                 ON CONFLICT(series_id) DO UPDATE SET
+                    series_works_count = excluded.series_works_count,
+                    primary_work_count = excluded.primary_work_count, title = excluded.title""",
+    "works": """INSERT INTO works (original_publication_year, work_id, original_title) VALUES (?, ?, ?)
+                ON CONFLICT(work_id) DO UPDATE SET
+                    original_publication_year = excluded.original_publication_year,
+                    original_title = excluded.original_title""",
+}
+
+def read_delta(file_path, table_name=None):
+    """Read the changes of a catalog sync.
+    A .jsonl file holds one change per line, with the columns of the tsv files
+    of format_data.py plus "table" and "op" ("upsert" by default, or "delete"):
+        {"table": "book_info", "book_id": 1, "title": "Emma", "authors": "17 42", ...}
+        {"table": "authors", "op": "delete", "author_id": 42}
+    Any other file is a tsv of table_name, every row of it an upsert.
+    :return
+        generator of dict, None for malformed rows
+    """
+    if file_path.endswith((".jsonl", ".json")):
+        with open(file_path) as f:
+            for line in f:
+                if line.strip():
+                    change = json.loads(line)
+                    change.setdefault("op", "upsert")
+                    yield change
+    else:
+        for values in read_tsv(file_path):
+            yield None if values is None else dict(values, table=table_name, op="upsert")
+
+def split_field(value, separators=" "):
+    """The ids or words of a delta field, given as a list or as a string like in the tsv files."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    value = str(value)
+    for separator in separators[1:]:
+        value = value.replace(separator, separators[0])
+    return [v for v in value.split(separators[0]) if v]
+
+def sync_catalog(conn, changes, book_fts, author_fts, batch_size=10000):
+    """Apply catalog changes in place of a full reload.
+    Books, series and works are upserted, the link rows and the fts row of a
+    changed book are replaced, books still on loan are not deleted. Only the
+    cards of the changed books are rebuilt and only the terms of the changed
+    titles and names are added to the spellfix vocabulary.
+    :params
+        conn: sqlite3.Connection
+        changes: iterable of dict as given by read_delta
+        book_fts: search object of the titles
+        author_fts: search object of the authors
+        batch_size: int changes per transaction
+    :return
+        Counter of "<table> <op>" and of the skipped changes
+    """
+    counts = Counter()
+    book_ids, author_ids = set(), set()
+    titles, names = [], []
+    c = conn.cursor()
+
+    def replace_links(book_id, table, values):
+        c.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+        c.executemany(LINK_INSERTS[table], ((book_id, v) for v in values))
+
+    def apply(change):
+        table, op = change.get("table"), change.get("op")
+        if table == "book_info" and op == "upsert":
+            if not change.get("title"):
+                return "missing title"
+            book_id = int(change["book_id"])
+            c.execute(CATALOG_UPSERTS["book_info"],
+                      tuple(change.get(col) for col in ("isbn", "format", "publisher", "num_pages", "country_code",
+                                                        "language_code", "publication_year", "book_id", "work_id")))
+            book_fts.delete_rows([book_id])
+            book_fts.index_rows([(book_id, change["title"])])
+            titles.append(change["title"])
+            # a field left out of a json change keeps its links
+            for field, link_table in BOOK_LINK_FIELDS.items():
+                if field in change:
+                    replace_links(book_id, link_table, split_field(change[field]))
+            if "genres" in change:
+                replace_links(book_id, "genres", split_field(change["genres"], " ,"))
+            book_ids.add(book_id)
+        elif table == "book_info" and op == "delete":
+            book_id = int(change["book_id"])
+            if c.execute(queries.BOOK_LOAN_QUERY, (book_id,)).fetchone():
+                return "on loan"
+            c.execute("DELETE FROM book_info WHERE book_id = ?", (book_id,))
+            for link_table in LINK_TABLES:
+                c.execute(f"DELETE FROM {link_table} WHERE book_id = ?", (book_id,))
+            book_fts.delete_rows([book_id])
+            book_ids.add(book_id)
+        elif table == "authors" and op == "upsert":
+            if not change.get("name"):
+                return "missing name"
+            author_id = int(change["author_id"])
+            author_fts.delete_rows([author_id])
+            author_fts.index_rows([(author_id, change["name"])])
+            names.append(change["name"])
+            author_ids.add(author_id)
+        elif table == "authors" and op == "delete":
+            author_id = int(change["author_id"])
+            author_fts.delete_rows([author_id])
+            book_ids.update(row[0] for row in c.execute(
+                "SELECT book_id FROM book_authors WHERE author_id = ?", (author_id,)))
+            c.execute("DELETE FROM book_authors WHERE author_id = ?", (author_id,))
+            author_ids.add(author_id)
+        elif table == "series" and op == "upsert":
+            c.execute(CATALOG_UPSERTS["series"], (change["series_id"], change.get("series_works_count"),
+                                                  change.get("primary_work_count"), change.get("title")))
+        elif table == "series" and op == "delete":
+            c.execute("DELETE FROM series WHERE series_id = ?", (change["series_id"],))
+            c.execute("DELETE FROM book_series WHERE series_id = ?", (change["series_id"],))
+        elif table == "works" and op == "upsert":
+            c.execute(CATALOG_UPSERTS["works"], (change.get("original_publication_year"), change["work_id"],
+                                                 change.get("original_title")))
+        elif table == "works" and op == "delete":
+            c.execute("DELETE FROM works WHERE work_id = ?", (change["work_id"],))
+        elif table == "genres" and op == "upsert":
+            replace_links(int(change["book_id"]), "genres", split_field(change.get("genres"), " ,"))
+        else:
+            return "unknown change"
+        return None
+
+    start = time.time()
+    count = 0
+    batch = []
+
+    def flush():
+        with conn:
+            for change in batch:
+                skipped = apply(change)
+                counts[f"{change.get('table')} {change.get('op')}" + (f" skipped, {skipped}" if skipped else "")] += 1
+        batch.clear()
+
+    for change in changes:
+        count += 1
+        if change is None:
+            counts["malformed"] += 1
+            continue
+        batch.append(change)
+        if len(batch) == batch_size:
+            flush()
+            report_throughput(count, start)
+    flush()
+
+    print("-- REFRESHING CHANGED BOOK CARDS AND VOCABULARY --")
+    with conn:
+        if schema_version(conn) >= 2 and (book_ids or author_ids):
+            book_lookup.refresh_book_cards(conn, book_ids, author_ids)
+        book_fts.add_vocabulary(titles)
+        author_fts.add_vocabulary(names)
+    if book_ids or author_ids:
+        book_lookup.metadata_cache.invalidate(book_ids, author_ids)
+    report_throughput(count, start)
+    return counts
+
+def index_size(conn, table_name):
+    """Return the bytes used by an fts table and its shadow tables.
+    Falls back to the size of the whole database if dbstat is not compiled in.
+    """
+    try:
+        row = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE ?", (table_name + "%",)).fetchone()
+        return row[0] or 0
+    except sqlite3.OperationalError:
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+def query_latency(fts, queries, limit=10):
+    """Average milliseconds of fts.search over the given queries.
+    The spellcheck cache is emptied first, so every run pays for spellfix.
+    """
+    search.spellcheck_cache.clear()
+    start = time.perf_counter()
+    for query in queries:
+        fts.search(query, limit=limit)
+    return (time.perf_counter() - start) / max(len(queries), 1) * 1000
+
+def migrate_fts(conn, backend, num_queries=50):
+    """Rebuild fts4_book and fts4_author with the given backend and print
+    index size and query latency before and after."""
+    for table_name in ["fts4_book", "fts4_author"]:
+        old_fts = search.create_search(conn, './spellfix', table_name)
+        current = search.detect_backend(conn, table_name)
+        if current == backend:
+            print(f"{table_name} already uses {backend}")
+            continue
+
+        # sample queries: the first word of some indexed rows
+        rows = conn.execute(f"SELECT * FROM {table_name} LIMIT ?", (num_queries,)).fetchall()
+        queries = [row[0].split()[0] for row in rows if row[0] and row[0].split()]
+
+        size_before = index_size(conn, table_name)
+        latency_before = query_latency(old_fts, queries)
+        print(f"-- REBUILDING {table_name} {current} -> {backend} --")
+        start = time.time()
+        new_fts = search.rebuild_index(conn, './spellfix', table_name, backend)
+        elapsed = time.time() - start
+        conn.execute("VACUUM")
+        size_after = index_size(conn, table_name)
+        latency_after = query_latency(new_fts, queries)
+        print(f"{table_name}: rebuilt in {elapsed:.1f}s, size {size_before / 2**20:.1f}MB -> {size_after / 2**20:.1f}MB, "
+              f"query latency {latency_before:.2f}ms -> {latency_after:.2f}ms")
+
 def main(args):
     conn = sqlite3.connect(args.db_file)
     c = conn.cursor()
     create_tables(c)
 
-    book_fts = search.FTS4SpellfixSearch(conn, './spellfix', table_name="fts4_book")
+    if args.migrate:
+        migrate(conn)
+        ok = check_query_plans(conn)
+        conn.close()
+        if not ok:
+            sys.exit(1)
+        return
+
+    if args.migrate_fts:
+        migrate_fts(conn, args.migrate_fts)
+        conn.close()
+        return
+
+    if args.link_account:
+        migrate(conn)
+        user_id = link_account(conn, args.link_account, args.user_id, *args.new_user)
+        print(f"account {identity.account_id(args.link_account)} -> user {user_id}")
+        conn.close()
+        return
+
+    book_fts = search.create_search(conn, './spellfix', "fts4_book")
     book_fts.create_schema()
 
-    author_fts = search.FTS4SpellfixSearch(conn, './spellfix', table_name="fts4_author")
+    author_fts = search.create_search(conn, './spellfix', "fts4_author")
     author_fts.create_schema()
 
     # print_tables(c)
@@ -190,13 +784,22 @@ def main(args):
     if args.table_name == "user":
         c.execute("""INSERT INTO users (user_first_name, user_last_name) VALUES ("john","doe")""")
         c.execute("""INSERT INTO users (user_first_name, user_last_name) VALUES ("amanda", "white")""")
+        seed_legacy_accounts(conn)
         # The Te of Piglet
         # c.execute("""INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?,?,?,?)""", (1, 89371, "01/10/2022", 0))
         # The Devil's Notebook
         # c.execute("""INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?,?,?,?)""", (1, 287149, "01/11/2022", 0))
         # Penny from Heaven
         # c.execute("""INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?,?,?,?)""", (1, 89377, "01/11/2022",1))
+    elif args.sync:
+        counts = sync_catalog(conn, read_delta(args.file_path, args.table_name), book_fts, author_fts,
+                              args.batch_size)
+        for change, n in sorted(counts.items()):
+            print(f"    {change:<40}{n:>8}")
+    elif args.bulk:
+        bulk_load(conn, args, book_fts, author_fts)
     else:
+        start = time.time()
         file = open(args.file_path)
         csvreader = csv.reader(file, delimiter="\t")
         header = next(csvreader)
@@ -241,18 +844,15 @@ def main(args):
                 
                 if values["series"]:
                     for series_id in values["series"].split(" "):
-                        c.execute("""INSERT INTO book_series (book_id, series_id) 
-                                    VALUES (?, ?)""", (values["book_id"], series_id))
+                        c.execute(LINK_INSERTS["book_series"], (values["book_id"], series_id))
 
                 if values["authors"]:
                     for author_id in values["authors"].split(" "):
-                        c.execute("""INSERT INTO book_authors (book_id, author_id) VALUES (?, ?)""", 
-                                    (values["book_id"], author_id))
+                        c.execute(LINK_INSERTS["book_authors"], (values["book_id"], author_id))
 
                 if values["similar_books"]:
                     for similar_book_id in values["similar_books"].split(" "):
-                        c.execute("""INSERT INTO book_similar_books (book_id, similar_book_id) VALUES (?, ?)""", 
-                                    (values["book_id"], similar_book_id))
+                        c.execute(LINK_INSERTS["book_similar_books"], (values["book_id"], similar_book_id))
 
             elif args.table_name == "authors":
                 author_fts.index_row((values["author_id"], values["name"]))
@@ -268,13 +868,18 @@ def main(args):
             elif args.table_name == "genres":
                 if values["genres"]:
                     for genre in values["genres"].replace(",","").split(" "):
-                        c.execute("""INSERT INTO genres (book_id, genre) VALUES (?, ?)""",
-                        (values["book_id"], genre))
+                        c.execute(LINK_INSERTS["genres"], (values["book_id"], genre))
 
         file.close()
+        report_throughput(count, start)
         print(f"Total {count}. Mismatch {mismatches}. Percentage {mismatches/ count * 100}")
 
     conn.commit()
+    if args.table_name in ("book_info", "authors") and schema_version(conn) >= 2 and not args.sync:
+        print("-- REFRESHING BOOK CARDS --")
+        with conn:
+            book_lookup.refresh_book_cards(conn)
+    migrate(conn)
     conn.close()
 
 if __name__ == "__main__": 
@@ -289,6 +894,30 @@ if __name__ == "__main__":
     parser.add_argument('--db_file',
                         help="name of the database", default="book_rent.db")
 
+    parser.add_argument('--bulk', action="store_true",
+                        help="load in batches and build the spellfix vocabulary once at the end")
+
+    parser.add_argument('--batch_size', type=int,
+                        help="number of input rows per transaction in bulk and sync mode", default=50000)
+
+    parser.add_argument('--sync', action="store_true",
+                        help="apply a delta (a .jsonl of changes or a tsv of --table_name) to an existing catalog")
+
+    parser.add_argument('--migrate', action="store_true",
+                        help="apply the pending schema migrations and check the query plans of the actions")
+
+    parser.add_argument('--migrate_fts', choices=list(search.SEARCH_BACKENDS),
+                        help="rebuild the title and author indexes with the given fts backend")
+
+    parser.add_argument('--link_account',
+                        help="account id (or Alexa sender id) to link to --user_id, or to a new user")
+
+    parser.add_argument('--user_id', type=int,
+                        help="existing user linked by --link_account")
+
+    parser.add_argument('--new_user', nargs=2, default=["", ""], metavar=("FIRST_NAME", "LAST_NAME"),
+                        help="names of the user created by --link_account without --user_id")
+
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
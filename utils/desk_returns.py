@@ -0,0 +1,82 @@
+"""
+    Process the returns scanned at the library desk.
+    Reads one book id per line (the output of the barcode scanner) from a file
+    or stdin and closes the active loans in batches, one transaction per batch.
+
+    python -m utils.desk_returns --db_file book_rent.db --input scans.txt
+    python -m utils.desk_returns --db_file benchmark.db --synthetic 100000
+"""
+
+import argparse
+from collections import Counter
+import sqlite3
+import sys
+import time
+
+from actions import borrow
+from actions import library_config as config
+from .database import report_throughput
+
+def read_scans(lines):
+    """Yield the book ids of the scanned lines, None for unreadable ones."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        yield int(line) if line.isdigit() else None
+
+def process(db, scans, batch_size):
+    """Return the scanned books in batches.
+    :params
+        db: sqlite3.Connection
+        scans: iterable of int book ids or None
+        batch_size: int books per transaction
+    :return
+        Counter of the statuses
+    """
+    statuses = Counter()
+    batch = []
+    start = time.time()
+    count = 0
+
+    def flush():
+        if batch:
+            statuses.update(result.status for result in borrow.return_books(db, batch).values())
+            batch.clear()
+
+    for book_id in scans:
+        count += 1
+        if book_id is None:
+            statuses["unreadable"] += 1
+            continue
+        batch.append(book_id)
+        if len(batch) == batch_size:
+            flush()
+            report_throughput(count, start)
+    flush()
+    report_throughput(count, start)
+    return statuses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='process the returns scanned at the desk')
+    parser.add_argument('--db_file', help="name of the database", default="book_rent.db")
+    parser.add_argument('--input', help="file with one scanned book id per line, stdin by default")
+    parser.add_argument('--batch_size', type=int, default=500, help="returns per transaction")
+    parser.add_argument('--synthetic', type=int,
+                        help="instead of reading scans, return this many of the active loans")
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.db_file, timeout=config.DB_BUSY_TIMEOUT)
+    db.execute("PRAGMA journal_mode = WAL")
+    if args.synthetic:
+        scans = [row[0] for row in db.execute(
+            "SELECT book_id FROM user_book WHERE is_returned = 0 ORDER BY RANDOM() LIMIT ?", (args.synthetic,))]
+        statuses = process(db, scans, args.batch_size)
+    elif args.input:
+        with open(args.input) as f:
+            statuses = process(db, read_scans(f), args.batch_size)
+    else:
+        statuses = process(db, read_scans(sys.stdin), args.batch_size)
+    db.close()
+    for status, count in statuses.most_common():
+        print(f"    {status:<20}{count:>8}")
@@ -2,93 +2,92 @@
     Format the json data to tsv.
 """
 
+import argparse
+import itertools
 import json
 import os
+import queue
+import threading
+import time
 from multiprocessing import Pool
 
-def persist(file_name, data_lines):
-    cols = ["isbn", 'series', "format", "authors", "publisher", "num_pages", "similar_books", "country_code",
-            "language_code", "publication_year", "book_id", "work_id", "title", "title_without_series"]
+BOOK_COLS = ["isbn", 'series', "format", "authors", "publisher", "num_pages", "similar_books", "country_code",
+             "language_code", "publication_year", "book_id", "work_id", "title", "title_without_series"]
 
+def output_path(file_name):
+    """Build the tsv path next to the json file, eg. data/goodreads_books.json -> data/books.tsv"""
     split = file_name.split("/")
     dir, file = "/".join(split[:-1]), split[-1].split("_")[-1].split(".")[0]
     format = "tsv"
-
-    new_file_name = os.path.join(dir, f"{file}.{format}")
-
-    with open(new_file_name, "w") as fout:
-        fout.write("\t".join(cols) + "\n")
-        for line in data_lines:
-            if line:
-                fout.write(line)
-
-
-def persistauth(file_name, data_lines):
-    cols = ["author_id", "name"]
-
-    split = file_name.split("/")
-    dir, file = "/".join(split[:-1]), split[-1].split("_")[-1].split(".")[0]
-    format = "tsv"
-
-    new_file_name = os.path.join(dir, f"{file}.{format}")
-
+    return os.path.join(dir, f"{file}.{format}")
+
+def write_lines(new_file_name, cols, lines):
+    """Write the header and then every line taken from the queue until None is received.
+    :params
+        new_file_name: str
+        cols: list of str
+        lines: queue.Queue of str
+    """
     with open(new_file_name, "w") as fout:
         fout.write("\t".join(cols) + "\n")
-        for line in data_lines:
+        while True:
+            line = lines.get()
+            if line is None:
+                break
             if line:
                 fout.write(line)
 
-
-def persistwork(file_name, data_lines):
-    cols = ["original_publication_year", "work_id", "original_title"]
-
-    split = file_name.split("/")
-    dir, file = "/".join(split[:-1]), split[-1].split("_")[-1].split(".")[0]
-    format = "tsv"
-
-    new_file_name = os.path.join(dir, f"{file}.{format}")
-
-    with open(new_file_name, "w") as fout:
-        fout.write("\t".join(cols) + "\n")
-        for line in data_lines:
-            if line:
-                fout.write(line)
-
-
-def persisseries(file_name, data_lines):
-    cols = ["series_id", "series_works_count", "primary_work_count", "title"]
-
-    split = file_name.split("/")
-    dir, file = "/".join(split[:-1]), split[-1].split("_")[-1].split(".")[0]
-    format = "tsv"
-
-    new_file_name = os.path.join(dir, f"{file}.{format}")
-
-    with open(new_file_name, "w") as fout:
-        fout.write("\t".join(cols) + "\n")
-        for line in data_lines:
-            if line:
-                fout.write(line)
-
-
-def persissgenres(file_name, data_lines):
-    cols = ["book_id", "genres"]
-
-    split = file_name.split("/")
-    dir, file = "/".join(split[:-1]), split[-1].split("_")[-1].split(".")[0]
-    format = "tsv"
-
-    new_file_name = os.path.join(dir, f"{file}.{format}")
-
-    with open(new_file_name, "w") as fout:
-        fout.write("\t".join(cols) + "\n")
-        for line in data_lines:
-            if line:
-                fout.write(line)
+def put_line(lines, line, writer, timeout=1.0):
+    """Queue a line for the writer, waiting for room only while the writer thread runs.
+    :raise
+        RuntimeError if the writer stopped, eg. on a write error, as its queue would never empty
+    """
+    while True:
+        try:
+            lines.put(line, timeout=timeout)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError("The tsv writer stopped before the end of the input")
+
+def convert(pool, file_name, cols, process_fn, chunksize, window, queue_size):
+    """Stream a json lines file through the pool and into a tsv file.
+    Only `window` input lines and `queue_size` output lines are in memory at any
+    time, so memory stays flat regardless of the input size.
+    :params
+        pool: multiprocessing.Pool
+        file_name: str of the json file
+        cols: list of str header of the tsv
+        process_fn: function converting one json line into one tsv line
+        chunksize: int lines sent to a worker at once
+        window: int lines read from the file at once
+        queue_size: int max number of lines waiting for the writer
+    :return
+        count: int number of converted lines
+        elapsed: float seconds
+    """
+    start = time.time()
+    count = 0
+    lines = queue.Queue(maxsize=queue_size)
+    writer = threading.Thread(target=write_lines, args=(output_path(file_name), cols, lines))
+    writer.start()
+    try:
+        with open(file_name, "r") as fin:
+            while True:
+                batch = list(itertools.islice(fin, window))
+                if not batch:
+                    break
+                for line in pool.imap_unordered(process_fn, batch, chunksize):
+                    put_line(lines, line, writer)
+                count += len(batch)
+    finally:
+        if writer.is_alive():
+            put_line(lines, None, writer)
+        writer.join()
+    return count, time.time() - start
 
 def process(line):
-    cols = ["isbn", 'series', "format", "authors", "publisher", "num_pages", "similar_books", "country_code",
-            "language_code", "publication_year", "book_id", "work_id", "title", "title_without_series"]
+    cols = BOOK_COLS
     book = []
     jsn = json.loads(line)
 
@@ -193,29 +192,41 @@ def processgenres(line):
     return '\t'.join(book) + "\n"
 
 
+# dataset name -> (json file, tsv header, line processor)
+DATASETS = {
+    "books": ("goodreads_books.json", BOOK_COLS, process),
+    "authors": ("goodreads_book_authors.json", ["author_id", "name"], processauth),
+    "works": ("goodreads_book_works.json", ["original_publication_year", "work_id", "original_title"], processwork),
+    "series": ("goodreads_book_series.json", ["series_id", "series_works_count", "primary_work_count", "title"],
+               processseries),
+    "genres": ("goodreads_book_genres_initial.json", ["book_id", "genres"], processgenres),
+}
+
 if __name__ == "__main__":
-    pool = Pool()
-    # lines = process_data(os.path.abspath("data/goodreads_books.json"), cols)
-    print("Starting the process...")
+    parser = argparse.ArgumentParser(description='convert the goodreads json files to tsv')
+
+    parser.add_argument('--datasets', nargs="+", choices=list(DATASETS), default=list(DATASETS),
+                        help='datasets to convert')
 
-    file_name = "data/goodreads_books.json"
-    data_lines = pool.map(process, open(os.path.abspath(file_name), "r").readlines())
-    persist(file_name, data_lines)
+    parser.add_argument('--data_dir', default="data",
+                        help='directory containing the json files')
 
-    # authpath = 'data/goodreads_book_authors.json'
-    # authdata = pool.map(processauth, open(os.path.abspath(authpath), "r").readlines())
-    # persistauth(authpath, authdata)
+    parser.add_argument('--chunksize', type=int, default=2000,
+                        help='lines sent to a worker at once')
 
-    # workpath = 'data/goodreads_book_works.json'
-    # workdata = pool.map(processwork, open(os.path.abspath(workpath), "r").readlines())
-    # persistwork(workpath, workdata)
+    parser.add_argument('--window', type=int, default=200000,
+                        help='lines read from the input file at once')
 
-    # seriespath = 'data/goodreads_book_series.json'
-    # seriesdata = pool.map(processseries, open(os.path.abspath(seriespath), "r").readlines())
-    # persisseries(seriespath, seriesdata)
+    parser.add_argument('--queue_size', type=int, default=50000,
+                        help='max number of converted lines waiting to be written')
 
-    # genrespath = 'data/goodreads_book_genres_initial.json'
-    # genresdata = pool.map(processgenres, open(os.path.abspath(genrespath), "r").readlines())
-    # persissgenres(genrespath, genresdata)
+    args = parser.parse_args()
 
-    pool.close()
+    print("Starting the process...")
+    with Pool() as pool:
+        for name in args.datasets:
+            json_file, cols, process_fn = DATASETS[name]
+            file_name = os.path.abspath(os.path.join(args.data_dir, json_file))
+            count, elapsed = convert(pool, file_name, cols, process_fn, args.chunksize, args.window, args.queue_size)
+            rate = count / elapsed if elapsed else 0
+            print(f"{name}: {count} lines in {elapsed:.1f}s ({rate:.0f} lines/s) -> {output_path(file_name)}")
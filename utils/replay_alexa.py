@@ -0,0 +1,182 @@
+"""
+    Load test of the Alexa connector on its own.
+    Replays Alexa request envelopes, read from a json lines file or synthesized
+    from the examples of data/nlu.yml, against the /webhook route of
+    AlexaConnector mounted in an in-process sanic app. The assistant is a stub
+    sleeping for a configurable time, so the time spent in the connector is
+    reported apart from the time spent waiting for the assistant, together with
+    the cpu time per request that bounds the throughput of one sanic worker.
+
+    python -m utils.replay_alexa --synthetic 1000 --concurrency 50
+    python -m utils.replay_alexa --input envelopes.jsonl --assistant_ms 200
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import random
+import re
+import time
+import uuid
+
+import yaml
+from sanic import Sanic
+
+from alexa_connector import AlexaConnector, LocalProgressiveSender, PENDING_MESSAGE
+from .benchmark_actions import percentile
+
+WEBHOOK = "/webhooks/alexa_assistant/webhook"
+
+class StubAssistant(object):
+    """Stands in for rasa: answers after a random delay and keeps the time spent per sender id."""
+    def __init__(self, delay, jitter, seed=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.seconds = defaultdict(float)
+
+    async def __call__(self, message):
+        start = time.perf_counter()
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.delay, self.jitter)))
+        await message.output_channel.send_text_message(message.sender_id, f"You said {message.text}")
+        self.seconds[message.sender_id] += time.perf_counter() - start
+
+def load_utterances(path="data/nlu.yml"):
+    """The examples of the nlu data without the entity annotations."""
+    with open(path) as f:
+        nlu = yaml.safe_load(f)["nlu"]
+    utterances = []
+    for item in nlu:
+        for line in item.get("examples", "").splitlines():
+            text = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", line.lstrip("- ").strip())
+            if text:
+                utterances.append(text)
+    return utterances
+
+def envelope(session_id, user_id, request_type, intent=None, text=None, new=False):
+    """An Alexa request in the shape of alexa_schema.json."""
+    request = {"type": request_type, "requestId": f"amzn1.echo-api.request.{uuid.uuid4()}",
+               "locale": "en-US"}
+    if intent:
+        request["intent"] = {"name": intent, "confirmationStatus": "NONE"}
+        if text is not None:
+            request["intent"]["slots"] = {"text": {"name": "text", "value": text}}
+    return {"version": "1.0",
+            "session": {"new": new, "sessionId": session_id, "user": {"userId": user_id}},
+            "context": {"System": {"user": {"userId": user_id}}},
+            "request": request}
+
+def synthesize(num_sessions, turns, utterances, seed=0):
+    """Sessions made of a launch, user utterances with an occasional repeat, and a stop."""
+    rng = random.Random(seed)
+    for i in range(num_sessions):
+        session_id = f"amzn1.echo-api.session.{i}"
+        user_id = f"amzn1.ask.account.{rng.randint(1, max(num_sessions // 4, 1))}"
+        yield envelope(session_id, user_id, "LaunchRequest", new=True)
+        for _ in range(rng.randint(1, turns)):
+            if rng.random() < 0.1:
+                yield envelope(session_id, user_id, "IntentRequest", "AMAZON.RepeatIntent")
+            else:
+                yield envelope(session_id, user_id, "IntentRequest", "ReturnUserInput", rng.choice(utterances))
+        yield envelope(session_id, user_id, "IntentRequest", "AMAZON.StopIntent")
+
+def read_envelopes(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def group_sessions(envelopes):
+    """Envelopes by session in arrival order, the turns of a session are replayed one after the other."""
+    sessions = defaultdict(list)
+    for e in envelopes:
+        sessions[e["session"]["sessionId"]].append(e)
+    return list(sessions.values())
+
+def request_kind(e):
+    return e["request"].get("intent", {}).get("name") or e["request"]["type"]
+
+async def replay(connector, assistant, sessions, concurrency):
+    """Replay the sessions, at most concurrency of them at a time.
+    :return
+        dict request kind -> list of (latency, assistant seconds, timed out)
+    """
+    app = Sanic("alexa_replay")
+    app.blueprint(connector.blueprint(assistant), url_prefix="/webhooks/alexa_assistant")
+    client = app.asgi_client
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = defaultdict(list)
+
+    async def one(session):
+        async with semaphore:
+            for e in session:
+                sender_id = e["session"]["user"]["userId"] + e["session"]["sessionId"]
+                assistant.seconds.pop(sender_id, None)
+                start = time.perf_counter()
+                _, resp = await client.post(WEBHOOK, data=json.dumps(e))
+                latency = time.perf_counter() - start
+                if resp.status != 200:
+                    raise RuntimeError(f"{request_kind(e)} failed with status {resp.status}")
+                timed_out = resp.json()["response"]["outputSpeech"]["text"] == PENDING_MESSAGE
+                # an answer finishing after a timeout is counted in full on the turn delivering it
+                assistant_seconds = min(assistant.seconds.pop(sender_id, 0.0), latency)
+                timings[request_kind(e)].append((latency, assistant_seconds, timed_out))
+
+    try:
+        await asyncio.gather(*[one(session) for session in sessions])
+    finally:
+        await client.aclose()
+    return timings
+
+def report(timings, elapsed, cpu_seconds, connector):
+    """Print the latency and the connector time per request kind.
+    The connector time is the latency minus the time the assistant took, the
+    requests cut by the response timeout are only counted in the timeouts.
+    """
+    total = sum(len(v) for v in timings.values())
+    print(f"{total} requests in {elapsed:.2f}s, {total / elapsed:.1f} requests/s")
+    print(f"{'request':<24}{'n':>6}{'timeouts':>10}{'p50 ms':>10}{'p99 ms':>10}{'assist ms':>11}"
+          f"{'conn p50':>10}{'conn p99':>10}")
+    for kind, values in sorted(timings.items()):
+        latencies = [latency for latency, _, _ in values]
+        answered = [(latency, assistant) for latency, assistant, timed_out in values if not timed_out]
+        overheads = [latency - assistant for latency, assistant in answered] or [float("nan")]
+        assistant_mean = sum(assistant for _, assistant in answered) / len(answered) if answered else float("nan")
+        print(f"{kind:<24}{len(values):>6}{len(values) - len(answered):>10}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}"
+              f"{assistant_mean * 1000:>11.2f}"
+              f"{percentile(overheads, 50) * 1000:>10.2f}{percentile(overheads, 99) * 1000:>10.2f}")
+    # the stub assistant only sleeps, the cpu time is the one of the connector, sanic and this driver
+    print(f"cpu {cpu_seconds * 1000 / total:.3f} ms per request, "
+          f"one worker saturates at about {total / cpu_seconds:.0f} requests/s")
+    print(f"progressive responses: {len(connector.progressive_sender.sent)}, sessions cached: {len(connector.sessions)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='replay alexa requests against the connector')
+    parser.add_argument('--input', help="json lines file of alexa request envelopes")
+    parser.add_argument('--synthetic', type=int, default=200, help="sessions to synthesize without --input")
+    parser.add_argument('--turns', type=int, default=6, help="max user turns of a synthesized session")
+    parser.add_argument('--concurrency', type=int, default=20, help="sessions replayed at the same time")
+    parser.add_argument('--assistant_ms', type=float, default=50, help="mean answer time of the stub assistant")
+    parser.add_argument('--assistant_jitter_ms', type=float, default=20)
+    parser.add_argument('--response_timeout', type=float, default=6.0)
+    parser.add_argument('--progressive_delay', type=float, default=1.5)
+    parser.add_argument('--dump', help="write the replayed envelopes to this json lines file")
+    args = parser.parse_args()
+
+    if args.input:
+        envelopes = list(read_envelopes(args.input))
+    else:
+        envelopes = list(synthesize(args.synthetic, args.turns, load_utterances()))
+    if args.dump:
+        with open(args.dump, "w") as f:
+            f.writelines(json.dumps(e) + "\n" for e in envelopes)
+
+    connector = AlexaConnector(response_timeout=args.response_timeout, progressive_delay=args.progressive_delay,
+                               progressive_sender=LocalProgressiveSender())
+    assistant = StubAssistant(args.assistant_ms / 1000, args.assistant_jitter_ms / 1000)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    timings = asyncio.run(replay(connector, assistant, group_sessions(envelopes), args.concurrency))
+    report(timings, time.perf_counter() - start, time.process_time() - cpu_start, connector)
@@ -0,0 +1,127 @@
+"""
+    Stress test of the borrow engine.
+    Many threads, each with its own connection, borrow and return a small set
+    of hot books for a handful of users. Afterwards the loans are checked for
+    books lent twice and users past the limit, and the throughput of every
+    second is printed.
+
+    python -m utils.stress_borrow --threads 16 --seconds 10
+    python -m utils.stress_borrow --legacy   # the old check then insert sequence
+"""
+
+import argparse
+from collections import Counter
+import datetime as dt
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from actions import borrow
+from actions import library_config as config
+from actions import queries
+from . import synthetic_db
+
+def legacy_borrow(db, user_id, book_id):
+    """The statements ActionPerformBorrow used to run, without a write transaction."""
+    c = db.cursor()
+    c.execute(queries.USER_BOOK_COUNT_QUERY, (user_id,))
+    if c.fetchone()[0] >= config.MAX_BOOK:
+        return borrow.BorrowResult(borrow.LIMIT_REACHED, None)
+    c.execute(queries.BOOK_LOAN_QUERY, (book_id,))
+    if c.fetchone():
+        return borrow.BorrowResult(borrow.NOT_AVAILABLE, None)
+    return_date = dt.date.today() + dt.timedelta(days=config.MAX_RENT_DAYS)
+    c.execute(queries.INSERT_LOAN_QUERY, (user_id, book_id, return_date.toordinal()))
+    db.commit()
+    return borrow.BorrowResult(borrow.BORROWED, return_date)
+
+def worker(db_file, args, seed, stop, results):
+    rng = random.Random(seed)
+    db = sqlite3.connect(db_file, timeout=config.DB_BUSY_TIMEOUT)
+    borrow_fn = legacy_borrow if args.legacy else borrow.borrow
+    statuses = Counter()
+    completed = []
+    while not stop.is_set():
+        user_id = rng.randint(1, args.num_users)
+        book_id = rng.randint(1, args.hot_books)
+        try:
+            if rng.random() < args.return_ratio:
+                status = borrow.return_book(db, user_id, book_id).status
+            else:
+                status = borrow_fn(db, user_id, book_id).status
+        except borrow.BusyError:
+            status = "busy"
+        except sqlite3.IntegrityError:
+            db.rollback()
+            status = "integrity_error"
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            status = "locked" if borrow.is_busy(e) else "error"
+        statuses[status] += 1
+        completed.append(time.perf_counter())
+    db.close()
+    results.append((statuses, completed))
+
+def check_loans(conn):
+    """Count the books with several active loans and the users past the limit."""
+    double_lent = conn.execute("""SELECT COUNT(*) FROM (SELECT book_id FROM user_book WHERE is_returned = 0
+                                  GROUP BY book_id HAVING COUNT(*) > 1)""").fetchone()[0]
+    over_limit = conn.execute("""SELECT COUNT(*) FROM (SELECT user_id FROM user_book WHERE is_returned = 0
+                                 GROUP BY user_id HAVING COUNT(*) > ?)""", (config.MAX_BOOK,)).fetchone()[0]
+    return double_lent, over_limit
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='stress test concurrent borrows')
+    parser.add_argument('--db_file', default="stress_borrow.db")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--num_books', type=int, default=1000)
+    parser.add_argument('--hot_books', type=int, default=50, help="borrows only target the first books")
+    parser.add_argument('--num_users', type=int, default=20)
+    parser.add_argument('--return_ratio', type=float, default=0.3, help="share of the operations returning a book")
+    parser.add_argument('--legacy', action="store_true", help="borrow without a write transaction")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db_file):
+        os.remove(args.db_file)
+    conn = synthetic_db.build(args.db_file, args.num_books, max(args.num_books // 5, 1), args.num_users)
+    conn.execute("PRAGMA journal_mode = WAL")
+    if args.legacy:
+        # without the unique index the double lending shows up in the loans instead of as errors
+        conn.execute("DROP INDEX IF EXISTS idx_user_book_one_active_loan")
+    conn.close()
+
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=worker, args=(args.db_file, args, seed, stop, results))
+               for seed in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter()
+    per_second = Counter()
+    for worker_statuses, completed in results:
+        statuses.update(worker_statuses)
+        per_second.update(int(t - start) for t in completed)
+    total = sum(statuses.values())
+    print(f"{total} operations in {elapsed:.1f}s with {args.threads} threads, {total / elapsed:.0f} ops/s")
+    for status, count in statuses.most_common():
+        print(f"    {status:<20}{count:>8}")
+    rates = [per_second[s] for s in range(int(args.seconds))]
+    if rates:
+        print(f"ops per second: min {min(rates)}, max {max(rates)}, {rates}")
+
+    conn = sqlite3.connect(args.db_file)
+    double_lent, over_limit = check_loans(conn)
+    conn.close()
+    print(f"books lent twice: {double_lent}, users past the limit of {config.MAX_BOOK}: {over_limit}")
+    if double_lent or over_limit:
+        raise SystemExit(1)
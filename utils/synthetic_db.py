@@ -0,0 +1,91 @@
+"""
+    Build a synthetic goodreads-like database for benchmarks.
+"""
+
+import datetime as dt
+import random
+import sqlite3
+
+from actions import queries
+from actions import search
+from . import database
+
+WORDS = ["dracula", "harry", "potter", "night", "house", "dark", "love", "war", "secret", "garden",
+         "shadow", "king", "queen", "river", "winter", "summer", "city", "game", "blood", "stone",
+         "girl", "boy", "island", "moon", "star", "fire", "ice", "world", "last", "lost"]
+
+FIRST_NAMES = ["john", "mary", "stephen", "jane", "george", "agatha", "neil", "ursula", "terry", "joanne"]
+
+LAST_NAMES = ["king", "austen", "martin", "christie", "gaiman", "le guin", "pratchett", "rowling", "stoker", "tolkien"]
+
+def create_fts_tables(conn):
+    """Create the fts4 tables without spellfix, enough for the lookup queries."""
+    conn.executescript(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS fts4_book USING fts4(title TEXT NOT NULL,);
+        CREATE VIRTUAL TABLE IF NOT EXISTS fts4_author USING fts4(author_name TEXT NOT NULL,);
+        """
+    )
+
+def build(db_file, num_books=100000, num_authors=20000, num_users=100, num_loans=0, spellfix1_path=None, seed=0):
+    """Fill a new database with random books, authors, users and loans.
+    :params
+        db_file: str path of the database
+        num_books: int
+        num_authors: int
+        num_users: int
+        num_loans: int number of active user_book rows
+        spellfix1_path: str, if given the spellfix vocabulary is built as well
+        seed: int for the random generator
+    :return
+        sqlite3.Connection
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_file)
+    database.create_tables(conn.cursor())
+    fts = []
+    if spellfix1_path:
+        for table_name in ["fts4_book", "fts4_author"]:
+            fts.append(search.create_search(conn, spellfix1_path, table_name, "fts4"))
+            fts[-1].create_schema()
+    else:
+        create_fts_tables(conn)
+
+    with conn:
+        conn.executemany("INSERT INTO users (user_id, user_first_name, user_last_name) VALUES (?, ?, ?)",
+                         ((uid, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)) for uid in range(1, num_users + 1)))
+        conn.executemany("INSERT INTO fts4_author (rowid, author_name) VALUES (?, ?)",
+                         ((aid, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {aid}")
+                          for aid in range(1, num_authors + 1)))
+
+        books, titles, book_authors = [], [], []
+        for bid in range(1, num_books + 1):
+            work_id = rng.randint(1, max(num_books // 4, 1))
+            books.append((None, rng.choice(["Paperback", "Hardcover", "ebook"]), None, rng.randint(50, 900),
+                          "US", "eng", rng.randint(1900, 2020), bid, work_id, 1))
+            titles.append((bid, " ".join(rng.sample(WORDS, rng.randint(1, 4)))))
+            for aid in rng.sample(range(1, num_authors + 1), rng.choice([1, 1, 1, 2, 3])):
+                book_authors.append((bid, aid))
+
+        conn.executemany("""INSERT INTO book_info (isbn, format, publisher, num_pages, country_code, language_code,
+                            publication_year, book_id, work_id, is_available) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         books)
+        conn.executemany("INSERT INTO fts4_book (rowid, title) VALUES (?, ?)", titles)
+        conn.executemany("INSERT INTO book_authors (book_id, author_id) VALUES (?, ?)", book_authors)
+
+        today = dt.date.today()
+        loans = []
+        for book_id in rng.sample(range(1, num_books + 1), min(num_loans, num_books)):
+            return_date = today + dt.timedelta(days=rng.randint(-10, 14))
+            loans.append((rng.randint(1, num_users), book_id, return_date.toordinal(), 0))
+        conn.executemany("INSERT INTO user_book (user_id, book_id, return_date, is_returned) VALUES (?, ?, ?, ?)",
+                         loans)
+
+    for f in fts:
+        f.build_vocabulary()
+    database.migrate(conn)
+    with conn:
+        # the sender account of every user is "user-<user_id>"
+        conn.executemany(queries.INSERT_USER_IDENTITY_QUERY,
+                         ((f"user-{uid}", uid) for uid in range(1, num_users + 1)))
+    return conn